@@ -0,0 +1,212 @@
+"""
+A compact binary format for traces, which `jsonl.write` uses for paths ending in
+`BINARY_EXTENSION` and `jsonl.read` detects by its header.
+
+Each key and value of the rows is interned in a table, so rows only refer to them by
+id. Values are interned all the way down, so the type dicts nested in the arguments
+of different calls, and the strings in them, are only written once. The file starts
+with `MAGIC`, followed by entries, each a tag byte, the length of the rest as a
+varint, and then:
+
+* `DEFINE`: JSON which gets the next id in the table
+* `DICT`: the ids of a dict's keys and values in turn, which gets the next id
+* `LIST`: the ids of a list's items, which gets the next id
+* `ROW`: the ids of the row's keys and values in turn
+* `CLEAR`: nothing, the table is emptied. Written when the table is full, so that
+  memory stays bounded
+
+Ids are written as the width in bytes of the largest one, followed by each as a
+little endian unsigned int of that width, so an entry is decoded with a single
+`struct` call instead of a loop over varints.
+"""
+import functools
+import struct
+import typing
+import warnings
+
+import orjson
+
+__all__ = ["BINARY_EXTENSION", "MAGIC", "Encoder", "read"]
+
+BINARY_EXTENSION = ".bin"
+MAGIC = b"\x00record_api\x01\n"
+
+DEFINE = ord("D")
+DICT = ord("M")
+LIST = ord("L")
+ROW = ord("R")
+CLEAR = ord("C")
+
+# Clear the table once it has this many items
+MAX_TABLE_SIZE = 2 ** 20
+# How many bytes to read at once
+BLOCK_SIZE = 2 ** 20
+
+# The struct format for ids of each width
+FORMATS = {1: "B", 2: "H", 4: "I"}
+
+
+def varint(n: int) -> bytes:
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+@functools.lru_cache(None)
+def ids_struct(width: int, n: int) -> struct.Struct:
+    return struct.Struct(f"<{n}{FORMATS[width]}")
+
+
+def write_ids(out: bytearray, tag: int, ids: typing.List[int]) -> None:
+    largest = max(ids, default=0)
+    width = 1 if largest <= 0xFF else 2 if largest <= 0xFFFF else 4
+    out.append(tag)
+    out += varint(1 + width * len(ids))
+    out.append(width)
+    out += ids_struct(width, len(ids)).pack(*ids)
+
+
+def read_ids(entry: bytes) -> typing.Tuple[int, ...]:
+    width = entry[0]
+    return ids_struct(width, (len(entry) - 1) // width).unpack_from(entry, 1)
+
+
+class Encoder:
+    """
+    Encodes rows as entries, passing `kwargs` to `orjson.dumps`.
+
+    The table is shared by all rows, so they have to be written in the order they
+    are encoded.
+    """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        # Maps serialized JSON, or the tag and item ids of a dict or list, to its id.
+        # The serialized values of rows are kept as well, so a value seen before is
+        # found without walking it again.
+        self.ids: typing.Dict[typing.Hashable, int] = {}
+        self.n_ids = 0
+        # Rows have the same few keys, so only serialize them once
+        self.keys: typing.Dict[str, bytes] = {}
+
+    def define(self, key: typing.Hashable) -> int:
+        i = self.ids[key] = self.n_ids
+        self.n_ids += 1
+        return i
+
+    def leaf(self, serialized: bytes, out: bytearray) -> int:
+        i = self.ids.get(serialized)
+        if i is None:
+            i = self.define(serialized)
+            out.append(DEFINE)
+            out += varint(len(serialized))
+            out += serialized
+        return i
+
+    def intern(self, value: object, out: bytearray) -> int:
+        if isinstance(value, dict):
+            tag = DICT
+            items = [self.intern(x, out) for item in value.items() for x in item]
+        elif isinstance(value, list):
+            tag = LIST
+            items = [self.intern(x, out) for x in value]
+        else:
+            return self.leaf(orjson.dumps(value), out)
+        key = (tag, *items)
+        i = self.ids.get(key)
+        if i is None:
+            i = self.define(key)
+            write_ids(out, tag, items)
+        return i
+
+    def __call__(self, o: dict) -> bytes:
+        out = bytearray()
+        table = self.ids
+        # A row can add more items than this, so the limit is not exact
+        if len(table) >= MAX_TABLE_SIZE:
+            out.append(CLEAR)
+            out += varint(0)
+            table.clear()
+            self.n_ids = 0
+        ids = []
+        keys = self.keys
+        for k, v in o.items():
+            try:
+                serialized_key = keys[k]
+            except KeyError:
+                serialized_key = keys[k] = orjson.dumps(k)
+            ids.append(self.leaf(serialized_key, out))
+            serialized = orjson.dumps(v, **self.kwargs)
+            i = table.get(serialized)
+            if i is None:
+                # Only new values are walked, to intern what they share with others
+                i = table[serialized] = self.intern(orjson.loads(serialized), out)
+            ids.append(i)
+        write_ids(out, ROW, ids)
+        return bytes(out)
+
+
+def read_entries(stream: typing.BinaryIO) -> typing.Iterator[typing.Tuple[int, bytes]]:
+    """
+    Yields the tag and the rest of each entry, reading the stream in large blocks.
+    """
+    data = b""
+    pos = 0
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        if not block:
+            if pos < len(data):
+                warnings.warn(f"Ignoring {len(data) - pos} bytes of a truncated entry")
+            return
+        data = data[pos:] + block
+        pos = 0
+        n = len(data)
+        while pos < n:
+            start = pos
+            tag = data[pos]
+            pos += 1
+            length = shift = 0
+            while pos < n:
+                byte = data[pos]
+                pos += 1
+                length |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            else:
+                # The length is in the next block
+                pos = start
+                break
+            if pos + length > n:
+                pos = start
+                break
+            yield tag, data[pos : pos + length]
+            pos += length
+
+
+def read(stream: typing.BinaryIO) -> typing.Iterator[dict]:
+    """
+    Yields the rows from a stream, after its `MAGIC`.
+
+    Interned values are decoded once and shared by the rows and values using them, so
+    the rows must not be mutated.
+    """
+    table: typing.List[object] = []
+    for tag, entry in read_entries(stream):
+        if tag == ROW:
+            ids = iter(read_ids(entry))
+            yield {table[k]: table[v] for k, v in zip(ids, ids)}  # type: ignore
+        elif tag == DEFINE:
+            table.append(orjson.loads(entry))
+        elif tag == DICT:
+            ids = iter(read_ids(entry))
+            table.append({table[k]: table[v] for k, v in zip(ids, ids)})  # type: ignore
+        elif tag == LIST:
+            table.append([table[i] for i in read_ids(entry)])
+        elif tag == CLEAR:
+            table.clear()
+        else:
+            raise ValueError(f"Unknown entry {tag!r} in binary trace")
@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import atexit
+import contextlib
 import dataclasses
 import dis
 import functools
@@ -7,20 +9,61 @@ import inspect
 import itertools
 import operator as op
 import os
+import re
 import sys
+import threading
 import types
 import warnings
+import weakref
 from typing import *
 
 from . import jsonl
 
 import opcode
+import orjson
 
 from . import get_stack
 
-__all__ = ["Tracer", "setup", "finalize", "get_tracer"]
+__all__ = [
+    "Tracer",
+    "MonitoringTracer",
+    "InstrumentTracer",
+    "ProfileTracer",
+    "setup",
+    "finalize",
+    "get_tracer",
+]
 
 DEBUG = os.environ.get("PYTHON_RECORD_API_DEBUG", False)
+AGGREGATE = os.environ.get("PYTHON_RECORD_API_AGGREGATE", "") not in ("", "0")
+# Number of bytes of grouped rows to keep in memory when aggregating, before
+# spilling them to disk
+AGGREGATE_MAX_SIZE = int(os.environ.get("PYTHON_RECORD_API_AGGREGATE_MAX_SIZE", 2 ** 30))
+# If set, rows are serialized and written from a background thread, queueing at
+# most this many rows
+QUEUE_SIZE = int(os.environ.get("PYTHON_RECORD_API_QUEUE_SIZE", 0))
+# What to do when the queue is full, either "block" until there is space or
+# "drop" the row
+BACKPRESSURE = os.environ.get("PYTHON_RECORD_API_BACKPRESSURE", "block")
+# How to trace, one of the keys of `TRACERS`
+MODE = os.environ.get("PYTHON_RECORD_API_MODE", "opcodes")
+# Stop tracing a call site after this many calls in a row without a new call
+SATURATION = int(os.environ.get("PYTHON_RECORD_API_SATURATION", 1000))
+# If set, each call site is fully traced this many times, then only every second
+# time this many times, and so on, with the gap growing by `SAMPLE_BACKOFF` each time
+SAMPLE = int(os.environ.get("PYTHON_RECORD_API_SAMPLE", 0))
+SAMPLE_BACKOFF = int(os.environ.get("PYTHON_RECORD_API_SAMPLE_BACKOFF", 2))
+# If set, stop tracing a code object after this many traced opcodes in a row
+# without a new call
+CODE_SATURATION = int(os.environ.get("PYTHON_RECORD_API_CODE_SATURATION", 0))
+# If set, trace a code object again after this many calls of it once it was stopped
+REARM = int(os.environ.get("PYTHON_RECORD_API_REARM", 0))
+# The families of opcodes to trace, from `OPCODE_FAMILIES`, or all of them if not set
+OPCODES = [
+    family
+    for family in os.environ.get("PYTHON_RECORD_API_OPCODES", "").split(",")
+    if family
+] or None
 
 
 # global cache for tracer based on env variables
@@ -29,22 +72,12 @@ TRACER = None
 context_manager: Optional[ContextManager] = None
 write_line: Optional[Callable[[dict], None]] = None
 
-FUNCTION_CALL_OP_NAMES = {
-    "CALL_METHOD",
-    "CALL_FUNCTION",
-    "CALL_FUNCTION_KW",
-    "CALL_FUNCTION_EX",
-    "LOAD_ATTR",
-    "BINARY_SUBSCR",
-}
-
-
 def get_tracer() -> Tracer:
     global TRACER
     if not TRACER:
         FROM_MODULES = os.environ["PYTHON_RECORD_API_TO_MODULES"].split(",")
         TO_MODULES = os.environ["PYTHON_RECORD_API_FROM_MODULES"].split(",")
-        TRACER = Tracer(FROM_MODULES, TO_MODULES)
+        TRACER = TRACERS[MODE](FROM_MODULES, TO_MODULES)
     return TRACER
 
 
@@ -140,6 +173,53 @@ def _encode_method_descriptor(m: types.MethodDescriptorType):
     return {"name": m.__name__, "class": m.__objclass__}
 
 
+# A hashable key for how a value is serialized, see `fingerprint`
+Fingerprint = Hashable
+
+
+@functools.singledispatch
+def fingerprint_value(o: object) -> Fingerprint:
+    """
+    Returns a hashable key for an object with a registered `encode`, which is equal
+    for two objects of the same type only if they are encoded the same.
+
+    By default, uses the serialized encoding, but register cheaper keys for hot types.
+    """
+    return orjson.dumps(encode(o), default=default)
+
+
+@fingerprint_value.register
+def _fingerprint_module(o: types.ModuleType):
+    return o.__name__
+
+
+@fingerprint_value.register(types.FunctionType)
+@fingerprint_value.register(type)
+def type_key(o) -> Fingerprint:
+    """
+    Returns a key for a type or function by what `encode_module_value` serializes it
+    to, so that keys don't keep them alive and re-created ones have the same key.
+    """
+    return (o.__module__, getattr(o, "__qualname__", o.__name__))
+
+
+@fingerprint_value.register
+def _fingerprint_method_descriptor(m: types.MethodDescriptorType):
+    return (m.__name__, type_key(m.__objclass__))
+
+
+@fingerprint_value.register
+def _fingerprint_method(m: types.MethodType):
+    return (m.__name__, fingerprint(m.__self__))
+
+
+@fingerprint_value.register
+def _fingerprint_builtin_function_method(m: types.BuiltinMethodType):
+    if isinstance(m.__self__, types.ModuleType):
+        return type_key(m)
+    return (m.__name__, fingerprint(m.__self__))
+
+
 try:
     import numpy
 except ImportError:
@@ -162,6 +242,25 @@ else:
     def encode_convert_to_ma(u: numpy.ma.core._convert2ma):
         return u._func.__name__
 
+    @fingerprint_value.register
+    def _fingerprint_array(a: numpy.ndarray):
+        return a.dtype.name
+
+    @fingerprint_value.register
+    def _fingerprint_dtype(d: numpy.dtype):
+        return d.name
+
+    @fingerprint_value.register
+    def _fingerprint_ufunc(u: numpy.ufunc):
+        return u.__name__
+
+    # From NumPy 1.25, functions which dispatch with `__array_function__` are
+    # instances of a type defined in C, wrapping the function they dispatch to, so
+    # encode them like functions
+    if not isinstance(numpy.sum, types.FunctionType):
+        encode.register(type(numpy.sum), encode_module_value)
+        fingerprint_value.register(type(numpy.sum), type_key)
+
 
 MAX_LIST = 10
 MAX_TUPLE = 10
@@ -176,31 +275,145 @@ def preprocess(o):
     All others primitive subclasses are replaced with their types.
 
     All non primitives subclasses are passed through to be handled by `default`.
+
+    Only the first items of containers are kept, without copying the rest, and
+    truncated containers are marked as `truncated`. Lists are then recorded like
+    tuples, as `{"t": "list", "v": [...], "truncated": true}`.
     """
-    tp = type(o)
+    tp: type = type(o)
     if tp == str and len(o) <= MAX_STRING:
         return o
     if tp == list:
-        return [preprocess(v) for v in o[:MAX_LIST]]
+        items = preprocess_items(o[:MAX_LIST])
+        if len(o) > MAX_LIST:
+            return {"t": "list", "v": items, "truncated": True}
+        return items
     if tp == dict:
-        return {
+        d: Dict[str, object] = {
             "t": "dict",
             "v": [
-                [preprocess(k), preprocess(v)] for k, v in list(o.items())[:MAX_DICT]
+                list(item)
+                for item in zip(
+                    preprocess_items(list(itertools.islice(o, MAX_DICT))),
+                    preprocess_items(list(itertools.islice(o.values(), MAX_DICT))),
+                )
             ],
         }
+        if len(o) > MAX_DICT:
+            d["truncated"] = True
+        return d
     if tp == tuple:
-        return {
-            "t": "tuple",
-            "v": [preprocess(v) for v in o[:MAX_TUPLE]],
-        }
+        d = {"t": "tuple", "v": preprocess_items(o[:MAX_TUPLE])}
+        if len(o) > MAX_TUPLE:
+            d["truncated"] = True
+        return d
     if isinstance(o, (int, float, bool, list, str, dict, tuple)):
         # Don't send literals of these
-        return {"t": encode_module_value(tp)}
+        return primitive_type(tp)
     # Other types will be encoded by the `default` function.
     return o
 
 
+def preprocess_items(items: Sequence) -> List:
+    """
+    Preprocesses the first items of a container. If they are all the same primitive
+    type, which is only recorded as its type, returns a shared list of its summary.
+    """
+    if items:
+        tp: type = type(items[0])
+        if (
+            tp not in (str, list, dict, tuple)
+            and isinstance(items[0], (int, float, bool, list, str, dict, tuple))
+            and all(type(item) is tp for item in items)
+        ):
+            return homogeneous_items(tp, len(items))
+    return [preprocess(item) for item in items]
+
+
+# Shared by the items of containers of primitives, so only create one for each type.
+# Not mutated, since rows are only serialized.
+@functools.lru_cache(None)
+def primitive_type(tp: type) -> Dict[str, object]:
+    return {"t": encode_module_value(tp)}
+
+
+# Shared by containers of `n` items of the same primitive type, so they aren't
+# summarized again for each. Not mutated either.
+@functools.lru_cache(None)
+def homogeneous_items(tp: type, n: int) -> List[Dict[str, object]]:
+    return [primitive_type(tp)] * n
+
+
+def fingerprint(o: Any) -> Fingerprint:
+    """
+    Returns a cheap hashable key for an object, which is equal for two objects only if
+    they are serialized the same by `preprocess` and `default`.
+
+    Raises a `TypeError` if we need a key of an unhashable object.
+    """
+    tp = type(o)
+    if tp == str:
+        return o if len(o) <= MAX_STRING else str
+    if tp == list:
+        return (
+            list,
+            len(o) > MAX_LIST,
+            *(fingerprint(v) for v in o[:MAX_LIST]),
+        )
+    if tp == dict:
+        return (
+            dict,
+            len(o) > MAX_DICT,
+            *(
+                (fingerprint(k), fingerprint(v))
+                for k, v in itertools.islice(o.items(), MAX_DICT)
+            ),
+        )
+    if tp == tuple:
+        return (
+            tuple,
+            len(o) > MAX_TUPLE,
+            *(fingerprint(v) for v in o[:MAX_TUPLE]),
+        )
+    if o is None or isinstance(o, (int, float, bool, list, str, dict, tuple)):
+        return type_key(tp)
+    if encode.dispatch(tp) is encode.dispatch(object):
+        # Not encoded, so only the type is serialized
+        return type_key(tp)
+    return (type_key(tp), fingerprint_value(o))
+
+
+def callable_key(fn: Callable) -> Fingerprint:
+    """
+    Returns a key for a function, which is equal for two functions only if they
+    are serialized the same and have the same signature.
+
+    Raises a `TypeError` for callables only serialized as their type, like partials
+    and callable instances, whose signatures can differ. We don't key them by
+    identity, which would keep them alive and never match re-created ones.
+    """
+    if encode.dispatch(type(fn)) is encode.dispatch(object):
+        raise TypeError(f"Can't key calls of {fn!r}")
+    return fingerprint(fn)
+
+
+def call_key(
+    fn: Callable, args: Tuple, kwargs: Mapping[str, Any], return_type: Any
+) -> Hashable:
+    """
+    Returns a key for a call, which is equal for two calls only if they
+    would be logged as the same row by `log_call`.
+
+    Raises a `TypeError` if the call contains an unhashable key.
+    """
+    return (
+        callable_key(fn),
+        tuple(fingerprint(a) for a in args),
+        tuple((k, fingerprint(v)) for k, v in kwargs.items()),
+        None if return_type is None else type_key(return_type),
+    )
+
+
 def default(o: object) -> object:
     """
     JSON encoder that special cases some types 
@@ -213,23 +426,6 @@ def default(o: object) -> object:
     return {"t": t}
 
 
-# cache this b/c its expensive
-@functools.lru_cache(None, False)
-def signature(fn):
-    return inspect.signature(fn)
-
-
-def safe_signature(fn):
-    """
-    If fn is hashable, cache it, otherwise dont use cached version
-    """
-    try:
-        hash(fn)
-    except Exception:
-        return inspect.signature(fn)
-    return signature(fn)
-
-
 @dataclasses.dataclass
 class Bound:
     """
@@ -255,35 +451,207 @@ class Bound:
 
     @classmethod
     def create(cls, fn, args, kwargs) -> Optional[Bound]:
-        try:
-            sig = safe_signature(fn)
-        except ValueError:
+        binder = get_binder(fn)
+        if binder is None:
             return None
-        try:
-            bound = sig.bind(*args, **kwargs)
-        except TypeError:
-            return None
-        b = cls()
-        for k, v in bound.arguments.items():
-            kind = sig.parameters[k].kind
+        return binder.bind(args, kwargs)
+
+
+@dataclasses.dataclass
+class Binder:
+    """
+    Binds arguments to the parameters of a signature, like `inspect.Signature.bind`,
+    without building `BoundArguments`.
+    """
+
+    # The name of each parameter which can be passed by position, in order, and
+    # whether it is positional only
+    positional: List[Tuple[str, bool]]
+    # How many of those have no default
+    n_required_positional: int
+    # The index of each parameter which can be passed by keyword, and whether it is
+    # keyword only
+    keywords: Dict[str, Tuple[int, bool]]
+    # The index of each positional only parameter
+    positional_only: Dict[str, int]
+    # The keyword only parameters with no default
+    required_kw_only: List[str]
+    var_positional: Optional[str]
+    var_keyword: Optional[str]
+
+    @classmethod
+    def from_signature(cls, sig: inspect.Signature) -> Binder:
+        binder = cls([], 0, {}, {}, [], None, None)
+        for i, param in enumerate(sig.parameters.values()):
+            kind = param.kind
+            required = param.default is inspect.Parameter.empty
             if kind == inspect.Parameter.POSITIONAL_ONLY:
-                b.pos_only.append((k, preprocess(v)))
+                binder.positional_only[param.name] = i
+                binder.positional.append((param.name, True))
             elif kind == inspect.Parameter.POSITIONAL_OR_KEYWORD:
-                b.pos_or_kw.append((k, preprocess(v)))
+                binder.positional.append((param.name, False))
+                binder.keywords[param.name] = i, False
             elif kind == inspect.Parameter.VAR_POSITIONAL:
-                b.var_pos = k, preprocess(v)
+                binder.var_positional = param.name
             elif kind == inspect.Parameter.KEYWORD_ONLY:
-                b.kw_only[k] = preprocess(v)
+                binder.keywords[param.name] = i, True
+                if required:
+                    binder.required_kw_only.append(param.name)
+            else:
+                binder.var_keyword = param.name
+            if required and kind in (
+                inspect.Parameter.POSITIONAL_ONLY,
+                inspect.Parameter.POSITIONAL_OR_KEYWORD,
+            ):
+                binder.n_required_positional = len(binder.positional)
+        return binder
+
+    def bind(self, args: Sequence, kwargs: Mapping[str, Any]) -> Optional[Bound]:
+        """
+        Returns the bound arguments, or `None` if they don't match the signature.
+        """
+        positional = self.positional
+        n_args = len(args)
+        if n_args > len(positional) and self.var_positional is None:
+            return None
+        for name, positional_only in positional[n_args : self.n_required_positional]:
+            if positional_only or name not in kwargs:
+                return None
+        for name in self.required_kw_only:
+            if name not in kwargs:
+                return None
+        by_keyword = []
+        for name, value in kwargs.items():
+            try:
+                i, keyword_only = self.keywords[name]
+            except KeyError:
+                if (
+                    self.var_keyword is None
+                    or self.positional_only.get(name, -1) >= n_args
+                ):
+                    # `inspect` doesn't pass positional only parameters which
+                    # weren't passed by position to `**kwargs`
+                    return None
+                # Arguments to `**kwargs` are not recorded
+                continue
+            if not keyword_only and i < n_args:
+                # Also passed by position
+                return None
+            by_keyword.append((i, name, keyword_only, value))
+
+        b = Bound()
+        for (name, positional_only), value in zip(positional, args):
+            if positional_only:
+                b.pos_only.append((name, preprocess(value)))
+            else:
+                b.pos_or_kw.append((name, preprocess(value)))
+        if n_args > len(positional):
+            b.var_pos = (  # type: ignore
+                self.var_positional,
+                preprocess(tuple(args[len(positional) :])),
+            )
+        # Keep the order of the parameters, like `BoundArguments`
+        for _, name, keyword_only, value in sorted(by_keyword, key=op.itemgetter(0)):
+            if keyword_only:
+                b.kw_only[name] = preprocess(value)
+            else:
+                b.pos_or_kw.append((name, preprocess(value)))
         return b
 
 
+# The binder for each callable, by `binder_key`, or `None` if it has no signature
+BINDERS: Dict[Hashable, Optional[Binder]] = {}
+# The binder for each callable without a `binder_key`, by id, with a weak reference
+# to check the callable is still alive
+BINDERS_BY_ID: Dict[int, Tuple[weakref.ref, Optional[Binder]]] = {}
+
+
+def binder_key(fn: Callable) -> Hashable:
+    """
+    Returns a key for the signature of a callable, shared by callables with the same
+    signature, like functions with the same code.
+
+    Raises `TypeError` for other callables, which we would have to key by the
+    callable itself, keeping it alive.
+    """
+    tp = type(fn)
+    if tp is types.MethodType:
+        func = fn.__func__  # type: ignore
+        if type(func) is types.FunctionType:
+            key = binder_key(func)
+            if type(key) is tuple:
+                # Bound methods don't have their first parameter
+                return tp, key
+    elif tp is types.FunctionType:
+        attributes = fn.__dict__
+        if "__wrapped__" not in attributes and "__signature__" not in attributes:
+            # Code objects with different defaults compare equal
+            return (
+                fn.__code__,  # type: ignore
+                len(fn.__defaults__ or ()),  # type: ignore
+                tuple(fn.__kwdefaults__ or ()),  # type: ignore
+            )
+    elif tp is types.BuiltinMethodType:
+        self_ = fn.__self__  # type: ignore
+        if self_ is not None and not isinstance(self_, types.ModuleType):
+            return (
+                tp,
+                self_ if isinstance(self_, type) else type(self_),
+                fn.__name__,
+            )
+    raise TypeError(f"Can't key the signature of {fn!r}")
+
+
+def get_binder(fn: Callable) -> Optional[Binder]:
+    try:
+        key = binder_key(fn)
+    except TypeError:
+        return get_binder_by_id(fn)
+    try:
+        return BINDERS[key]
+    except KeyError:
+        binder = BINDERS[key] = create_binder(fn)
+        return binder
+
+
+def get_binder_by_id(fn: Callable) -> Optional[Binder]:
+    key = id(fn)
+    entry = BINDERS_BY_ID.get(key)
+    if entry and entry[0]() is fn:
+        return entry[1]
+    try:
+        ref = weakref.ref(fn, lambda _: BINDERS_BY_ID.pop(key, None))
+    except TypeError:
+        # Can't be cached by id without keeping it alive, so by what it's serialized
+        # as, if that's more than its type, like for ufuncs
+        try:
+            name_key = "callable", callable_key(fn)
+        except TypeError:
+            return create_binder(fn)
+        try:
+            return BINDERS[name_key]
+        except KeyError:
+            binder = BINDERS[name_key] = create_binder(fn)
+            return binder
+    binder = create_binder(fn)
+    BINDERS_BY_ID[key] = (ref, binder)
+    return binder
+
+
+def create_binder(fn: Callable) -> Optional[Binder]:
+    try:
+        return Binder.from_signature(inspect.signature(fn))
+    except ValueError:
+        return None
+
+
 def log_call(
     location: str,
     fn: Callable,
     args: Iterable = (),
     kwargs: Mapping[str, Any] = {},
     return_type: Any = None,
-) -> None:
+) -> Dict:
     bound = Bound.create(fn, args, kwargs)
     line: Dict = {"location": location, "function": preprocess(fn)}
     if bound is None:
@@ -298,34 +666,302 @@ def log_call(
         line['return_type'] = return_type
     assert write_line
     write_line(line)
+    return line
 
 
 @dataclasses.dataclass
-class Stack:
-    tracer: Tracer
-    frame: Any
-    NULL: ClassVar[object] = object()
-    current_i: int = dataclasses.field(init=False, default=0)
-    opcode: int = dataclasses.field(init=False)
-    previous_stack: Optional[Stack] = None
-    log_call_args: Tuple = ()
+class LoggedCall:
+    # The row written the first time this call was seen. Serialized once logged,
+    # so it doesn't keep the arguments alive, but from the writer's thread if it
+    # has one, see `serialize`.
+    row: Union[bytes, Dict]
+    # How many times this call was made
+    count: int = 1
+
+    def serialize(self) -> bytes:
+        """
+        Serializes the row, if it isn't yet, returning it.
+        """
+        # Read once, since this is called from the writer's thread
+        row = self.row
+        if not isinstance(row, bytes):
+            row = self.row = orjson.dumps(row, default=default)
+        return row
+
+
+@dataclasses.dataclass
+class SampledSite:
+    """
+    Sampling state for a call site, when `SAMPLE` is set.
+    """
+
+    # Executions since the site was last traced
+    skipped: int = 0
+    # Executions since the site was last traced, including that one, which are
+    # counted to the call it makes
+    uncounted: int = 0
+    # How many times the site was traced with the current gap
+    n_traced: int = 0
+    # Only every `gap`-th execution is traced
+    gap: int = 1
+    # The call logged by the last traced execution, if it was logged, which the
+    # executions skipped after it are counted to at the end
+    last: Optional[LoggedCall] = None
+
+
+@dataclasses.dataclass
+class TracedCode:
+    """
+    Tracing state for a code object from `calls_from_modules`.
+    """
+
+    instructions: List[Optional[Instruction]]
+    # The calls logged at each bytecode offset, keyed by `call_key`, so we only
+    # log each once and count the rest.
+    call_sites: Dict[int, Dict[Hashable, LoggedCall]] = dataclasses.field(
+        default_factory=dict
+    )
+    # The local trace function for frames executing this code
+    local_tracer: Optional[Callable] = None
+    # The sampling state at each bytecode offset
+    sampled_sites: Dict[int, SampledSite] = dataclasses.field(default_factory=dict)
+    # Executions of each traced opcode, by offset, since it last made a new call,
+    # when `CODE_SATURATION` is set
+    unchanged_executions: Dict[int, int] = dataclasses.field(default_factory=dict)
+    # How many opcodes have gone `CODE_SATURATION` executions without a new call
+    saturated_offsets: int = 0
+    # Whether we stopped tracing this code, since none of its opcodes make new calls
+    saturated: bool = False
+    # Calls of this code since it was saturated
+    saturated_calls: int = 0
+    # How many opcodes we trace, which all have to saturate
+    n_instructions: int = dataclasses.field(init=False, repr=False)
 
     def __post_init__(self):
-        self.op_stack = get_stack.OpStack(self.frame)
-        self.opcode = self.frame.f_code.co_code[self.frame.f_lasti]
+        self.n_instructions = sum(1 for instruction in self.instructions if instruction)
+
+    def count_execution(self, offset: int) -> None:
+        executions = self.unchanged_executions[offset] = (
+            self.unchanged_executions.get(offset, 0) + 1
+        )
+        if executions == CODE_SATURATION:
+            self.saturated_offsets += 1
+            if self.saturated_offsets >= self.n_instructions:
+                self.saturated = True
+
+    def reset_saturation(self) -> None:
+        self.saturated = False
+        self.unchanged_executions.clear()
+        self.saturated_offsets = self.saturated_calls = 0
+
+    def rearm(self) -> bool:
+        """
+        Counts a call of this code once it is saturated, returning whether to trace
+        it again.
+        """
+        self.saturated_calls += 1
+        if not REARM or self.saturated_calls < REARM:
+            return False
+        self.reset_saturation()
+        return True
+
+    def sample(self, offset: int) -> int:
+        """
+        Returns how many executions of the call site at the offset to count the call
+        made by this one as, or 0 if it shouldn't be traced.
+
+        Each traced execution counts for the executions skipped before it, so only
+        the call it makes is counted for them.
+        """
+        try:
+            site = self.sampled_sites[offset]
+        except KeyError:
+            site = self.sampled_sites[offset] = SampledSite()
+        site.uncounted += 1
+        site.skipped += 1
+        if site.skipped < site.gap:
+            return False
+        site.skipped = 0
+        site.n_traced += 1
+        if site.n_traced == SAMPLE:
+            site.n_traced = 0
+            site.gap *= SAMPLE_BACKOFF
+        count, site.uncounted = site.uncounted, 0
+        site.last = None
+        return count
+
+    def log(
+        self,
+        offset: int,
+        location: str,
+        fn: Callable,
+        args: Tuple,
+        kwargs: Mapping[str, Any],
+        return_type: Any = None,
+        count: int = 1,
+    ) -> bool:
+        """
+        Logs a call, unless the same call was already logged at this offset, in which
+        case we only count it, as `count` calls.
 
-        if self.previous_stack and self.previous_stack.previous_stack:
-            del self.previous_stack.previous_stack
+        Returns whether this was a new call. Calls we can't key are logged each time,
+        but aren't new, so that they don't keep their call site from saturating.
+        """
+        try:
+            key = call_key(fn, args, kwargs, return_type)
+        except TypeError:
+            key = None
+        logged_calls = self.call_sites.setdefault(offset, {})
+        site = self.sampled_sites.get(offset)
+        if key is not None and key in logged_calls:
+            logged = logged_calls[key]
+            logged.count += count
+            if site:
+                site.last = logged
+            return False
+        # Don't pass kwargs or return type if not used, so we can more easily test mock calls
+        line = log_call(
+            location,
+            fn,
+            args,
+            *((kwargs,) if kwargs else ()),
+            **({"return_type": return_type} if return_type is not None else {}),
+        )
+        if key is None:
+            return False
+        logged = logged_calls[key] = LoggedCall(line, count)
+        # Serialize from the background writer's thread, if there is one
+        call_soon = getattr(write_line, "call_soon", None)
+        if not (call_soon and call_soon(logged.serialize)):
+            logged.serialize()
+        if site:
+            site.last = logged
+        if CODE_SATURATION:
+            executions = self.unchanged_executions.pop(offset, 0)
+            if executions >= CODE_SATURATION:
+                self.saturated_offsets -= 1
+        return True
+
+    def flush_counts(self) -> None:
+        """
+        Writes the calls made more than once since they were logged, with a `count`
+        of how many more times they were made.
+        """
+        assert write_line
+        for site in self.sampled_sites.values():
+            if site.last and site.uncounted:
+                site.last.count += site.uncounted
+                site.uncounted = 0
+        for logged_calls in self.call_sites.values():
+            for logged in logged_calls.values():
+                if logged.count > 1:
+                    row = orjson.loads(logged.serialize())
+                    write_line({**row, "count": logged.count - 1})
+                    logged.count = 1
+
+
+class Instruction(NamedTuple):
+    """
+    An instruction `Stack` handles, with its `EXTENDED_ARG` decoded argument.
+    """
+
+    opname: str
+    oparg: int
+    handler: Callable[[Stack], None]
+    # The operator called, for unary and binary operators
+    operator: Optional[Callable] = None
+
+
+def interesting_instructions(
+    code: types.CodeType, handlers: Optional[Dict[int, Tuple]] = None
+) -> List[Optional[Instruction]]:
+    """
+    Returns a list, indexed by bytecode offset, of the instructions in `code`
+    that we handle, with `None` for all others. Only handles the opcodes in
+    `handlers`, which default to `OPCODE_HANDLERS`.
+
+    We build this once per code object so that, when tracing, opcodes we don't
+    care about are skipped with a single lookup. Decodes arguments like
+    `dis._unpack_opargs`, including `EXTENDED_ARG`.
+
+    Instructions with `EXTENDED_ARG` prefixes are stored at the offset of the first
+    prefix, since the interpreter jumps from the prefixes to the instruction without
+    another trace event, leaving `f_lasti` at the first prefix.
+    """
+    if handlers is None:
+        handlers = OPCODE_HANDLERS
+    co_code = code.co_code
+    instructions: List[Optional[Instruction]] = [None] * len(co_code)
+    extended_arg = 0
+    start: Optional[int] = None
+    for i in range(0, len(co_code), 2):
+        op = co_code[i]
+        arg = co_code[i + 1] | extended_arg
+        if op == opcode.EXTENDED_ARG:
+            extended_arg = arg << 8
+            if start is None:
+                start = i
+            continue
+        extended_arg = 0
+        handled = handlers.get(op)
+        if handled:
+            opname, handler, operator = handled
+            instructions[i if start is None else start] = Instruction(
+                opname, arg, handler, operator
+            )
+        start = None
+    return instructions
+
+
+class Stack:
+    """
+    Handles the opcodes of a thread, reused for each one so that tracing an opcode
+    doesn't create any objects, unless we log a call.
+    """
+
+    __slots__ = (
+        "tracer",
+        "frame",
+        "code",
+        "instruction",
+        "current_i",
+        "frame_id",
+        "op_stack",
+        "pending_call",
+        "count",
+    )
+    NULL: ClassVar[object] = object()
+
+    # The view of the value stack of the frame with id `frame_id`. Frames at the same
+    # address have the same layout, so it doesn't keep the frame alive. Set on the
+    # first opcode, before any handler runs.
+    op_stack: get_stack.OpStack
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        # The frame and code of the opcode we are handling, only while handling it
+        self.frame: Any = None
+        self.code: Optional[TracedCode] = None
+        # `None` if this opcode isn't one we handle, in which case we are only
+        # here to log the return type of the previous call.
+        self.instruction: Optional[Instruction] = None
+        # How many executions to count the call this opcode makes as, see
+        # `TracedCode.sample`
+        self.count = 1
+        self.current_i = 0
+        self.frame_id = 0
+        # The code and `TracedCode.log` arguments of the last call, which we are
+        # waiting to log with its return type on the next opcode
+        self.pending_call: Optional[Tuple] = None
 
     @property
-    def oparg(self):
-        # sort of replicates logic in dis._unpack_opargs but doesn't account for extended
-        # args, oh well!
-        return self.frame.f_code.co_code[self.frame.f_lasti + 1]
+    def oparg(self) -> int:
+        assert self.instruction
+        return self.instruction.oparg
 
     @property
-    def opname(self):
-        return opcode.opname[self.opcode]
+    def opname(self) -> Optional[str]:
+        return self.instruction.opname if self.instruction else None
 
     @property
     def opvalname(self):
@@ -388,52 +1024,76 @@ class Stack:
         # Note: This take args as an iterable, instead of as a varargs, so that if
         # we don't trace we don't have to expand the iterable
         if self.tracer.should_trace(*keyed_args):
-            filename = self.frame.f_code.co_filename
-            line = self.frame.f_lineno
-            # Don't pass kwargs if not used, so we can more easily test mock calls
+            offset = self.frame.f_lasti
+            location = f"{self.frame.f_code.co_filename}:{self.frame.f_lineno}"
+            assert self.code
             if not delay:
-                log_call(f"{filename}:{line}", fn, tuple(args), *((kwargs,) if kwargs else ()))
+                self.code.log(
+                    offset, location, fn, tuple(args), kwargs, count=self.count
+                )
             else:
-                self.log_call_args = (filename, line, fn, tuple(args), kwargs)
-
-    def __call__(self) -> None:
+                self.pending_call = (
+                    self.code,
+                    offset,
+                    location,
+                    fn,
+                    tuple(args),
+                    kwargs,
+                    self.count,
+                )
+
+    def __call__(
+        self,
+        frame,
+        code: TracedCode,
+        instruction: Optional[Instruction],
+        count: int = 1,
+    ) -> None:
         """
         handle all opcodes from https://docs.python.org/3/library/dis.html
         that we care about
         """
-        opname = self.opname
-        if opname in UNARY_OPS:
-            return self.process((self.TOS,), UNARY_OPS[opname], (self.TOS,))
-
-        if opname in BINARY_OPS:
-            return self.process(
-                (self.TOS, self.TOS1), BINARY_OPS[opname], (self.TOS1, self.TOS)
-            )
+        self.frame = frame
+        self.code = code
+        self.instruction = instruction
+        self.count = count
+        self.current_i = 0
+        if id(frame) != self.frame_id:
+            self.frame_id = id(frame)
+            self.op_stack = get_stack.OpStack(frame)
+        pending_call, self.pending_call = self.pending_call, None
+        try:
+            if instruction and instruction.operator:
+                instruction.handler(self)
+                return None
 
-        if self.previous_stack and self.previous_stack.opname in FUNCTION_CALL_OP_NAMES:
-            self.log_called_method()
+            if pending_call:
+                self.log_called_method(pending_call)
 
-        method_name = f"op_{opname}"
-        if hasattr(self, method_name):
-            getattr(self, method_name)()
+            if instruction:
+                instruction.handler(self)
+        finally:
+            self.frame = None
         return None
 
-    def log_called_method(self):
-        if self.previous_stack.log_call_args:
-            tos = self.TOS
-            if type(tos) is type and issubclass(tos, Exception):
-                # Don't record exception
-                return
-            return_type = type(tos) if type(tos) != type else tos
-            filename, line, fn, args, *kwargs = self.previous_stack.log_call_args
-            kwargs = kwargs[0] if kwargs else {}
-            log_call(
-                f"{filename}:{line}",
-                fn,
-                tuple(args),
-                *((kwargs,) if kwargs else ()),
-                return_type=return_type,
-            )
+    def unary_op(self) -> None:
+        assert self.instruction and self.instruction.operator
+        self.process((self.TOS,), self.instruction.operator, (self.TOS,))
+
+    def binary_op(self) -> None:
+        assert self.instruction and self.instruction.operator
+        self.process(
+            (self.TOS, self.TOS1), self.instruction.operator, (self.TOS1, self.TOS)
+        )
+
+    def log_called_method(self, pending_call: Tuple) -> None:
+        tos = self.TOS
+        if type(tos) is type and issubclass(tos, Exception):
+            # Don't record exception
+            return
+        return_type = type(tos) if type(tos) != type else tos
+        code, *log_call_args, count = pending_call
+        code.log(*log_call_args, return_type=return_type, count=count)
 
     # special case subscr b/c we only check first arg, not both
     def op_BINARY_SUBSCR(self):
@@ -481,7 +1141,7 @@ class Stack:
         # list from
         # https://github.com/python/cpython/blob/81de3c225774179cdc82a1733a64e4a876ff02b5/Lib/opcode.py#L24-L25
         val = self.opvalcompare
-        COMPARISONS = {
+        COMPARISONS: Dict[str, Callable] = {
             "<": op.lt,
             "<=": op.le,
             "==": op.eq,
@@ -547,7 +1207,7 @@ class Stack:
             )
 
 
-UNARY_OPS = {
+UNARY_OPS: Dict[str, Callable] = {
     "UNARY_POSITIVE": op.pos,
     "UNARY_NEGATIVE": op.neg,
     "UNARY_NOT": op.not_,
@@ -560,7 +1220,7 @@ UNARY_OPS = {
 }
 
 
-BINARY_OPS = {
+BINARY_OPS: Dict[str, Callable] = {
     "BINARY_POWER": op.pow,
     "BINARY_MULTIPLY": op.mul,
     "BINARY_MATRIX_MULTIPLY": op.matmul,
@@ -590,51 +1250,299 @@ BINARY_OPS = {
 }
 
 
+# Maps each opcode we handle to its name, its `Stack` handler and, for unary and
+# binary operators, the operator it calls.
+OPCODE_HANDLERS: Dict[int, Tuple[str, Callable[[Stack], None], Optional[Callable]]] = {
+    opcode.opmap[opname]: (opname, handler, operator)
+    for opname, handler, operator in itertools.chain(
+        ((opname, Stack.unary_op, fn) for opname, fn in UNARY_OPS.items()),
+        ((opname, Stack.binary_op, fn) for opname, fn in BINARY_OPS.items()),
+        (
+            (name[len("op_") :], getattr(Stack, name), None)
+            for name in dir(Stack)
+            if name.startswith("op_")
+        ),
+    )
+    # Skip opcodes which don't exist in this version of Python
+    if opname in opcode.opmap
+}
+
+# The names of the opcodes we handle, by the family they can be selected with
+OPCODE_FAMILIES: Dict[str, List[str]] = {
+    "calls": [
+        "CALL_FUNCTION",
+        "CALL_FUNCTION_KW",
+        "CALL_FUNCTION_EX",
+        "CALL_METHOD",
+        "BUILD_TUPLE_UNPACK_WITH_CALL",
+    ],
+    "operators": [
+        "UNARY_POSITIVE",
+        "UNARY_NEGATIVE",
+        "UNARY_NOT",
+        "UNARY_INVERT",
+        *BINARY_OPS,
+        "COMPARE_OP",
+    ],
+    "attributes": ["LOAD_ATTR", "STORE_ATTR", "DELETE_ATTR"],
+    "subscripts": ["BINARY_SUBSCR", "STORE_SUBSCR", "DELETE_SUBSCR"],
+    "iteration": [
+        "GET_ITER",
+        "GET_YIELD_FROM_ITER",
+        "UNPACK_SEQUENCE",
+        "UNPACK_EX",
+        "FOR_ITER",
+        "BUILD_TUPLE_UNPACK",
+        "BUILD_LIST_UNPACK",
+        "BUILD_SET_UNPACK",
+    ],
+}
+
+
+def opcode_handlers(families: Collection[str]) -> Dict[int, Tuple]:
+    """
+    Returns the items of `OPCODE_HANDLERS` for the opcodes in the families.
+    """
+    unknown = set(families) - OPCODE_FAMILIES.keys()
+    if unknown:
+        raise ValueError(
+            f"Unknown opcode families {sorted(unknown)}, must be from {list(OPCODE_FAMILIES)}"
+        )
+    opnames = {opname for family in families for opname in OPCODE_FAMILIES[family]}
+    return {
+        op: handled for op, handled in OPCODE_HANDLERS.items() if handled[0] in opnames
+    }
+
+
+class ThreadState(threading.local):
+    """
+    Tracing state which is separate for each thread.
+    """
+
+    # Handles the opcodes traced in this thread, created on the first one
+    stack: Optional[Stack] = None
+
+    # The call we expect to start next, when monitoring, so we can get its arguments
+    # from its frame
+    expected_call: Optional[Tuple] = None
+
+    def __init__(self):
+        # The calls we are waiting to log when their frame returns, by frame id,
+        # when profiling
+        self.pending_calls: Dict[int, Tuple] = {}
+        # The calls which started, with their frames, we are waiting to log when
+        # they return, when monitoring
+        self.started_calls: List[Tuple] = []
+
+
 @dataclasses.dataclass
 class Tracer:
     # the modules we should trace calls to
     calls_to_modules: List[str]
     # the modules we should trace calls from
     calls_from_modules: List[str]
-    previous_stack: Optional[Stack] = None
+    thread_state: ThreadState = dataclasses.field(
+        default_factory=ThreadState, repr=False
+    )
+    # The tracing state for each code object, or `None` if frames executing it
+    # should not be traced. Computed on the first call of each code object so
+    # other frames never get a local tracer.
+    code_cache: Dict[types.CodeType, Optional[TracedCode]] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+    # The families of opcodes to trace, from `OPCODE_FAMILIES`. Defaults to `OPCODES`
+    opcodes: Optional[Collection[str]] = None
+    # The handlers for the opcodes we trace, from `OPCODE_HANDLERS`
+    opcode_handlers: Dict[int, Tuple] = dataclasses.field(init=False, repr=False)
+
+    # Whether to trace values of each type, or `None` if it depends on the value,
+    # and whether its instances have a `__dict__` which could override that
+    type_decisions: Dict[type, Tuple[Optional[bool], bool]] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+    # Whether to trace values which are decided on their own, like functions and
+    # classes, by id, with a weak reference to check the value is still alive
+    value_decisions: Dict[int, Tuple[weakref.ref, bool]] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+    # Whether to trace each module name
+    module_decisions: Dict[str, bool] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+    # Whether we are between `__enter__` and `__exit__`. Threads started in between
+    # keep calling us after, so we check this to stop tracing them.
+    active: bool = dataclasses.field(default=False, init=False, repr=False)
+
+    def __post_init__(self):
+        opcodes = self.opcodes if self.opcodes is not None else OPCODES
+        self.opcode_handlers = (
+            OPCODE_HANDLERS if opcodes is None else opcode_handlers(opcodes)
+        )
 
     def __enter__(self):
+        self.active = True
+        # Also trace threads started from now on
+        threading.settrace(self)
         sys.settrace(self)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.active = False
         sys.settrace(None)
+        threading.settrace(None)  # type: ignore
 
     def should_trace(self, *values) -> bool:
         for value in values:
-            if isinstance(value, types.BuiltinMethodType):
-                # if this was a method defined in C, use the instance as the value
-                value = value.__self__
-            module = getmodulename(value) or getmodulename(type(value))
-
-            if not module:
-                warnings.warn(f"Cannot get module of {value}")
-                continue
-            if any(module.startswith(mod) for mod in self.calls_to_modules):
+            tp = type(value)
+            try:
+                decision, has_dict = self.type_decisions[tp]
+            except KeyError:
+                decision, has_dict = self.type_decisions[tp] = self.decide_type(tp)
+            if decision is None or (
+                has_dict and "__module__" in getattr(value, "__dict__", ())
+            ):
+                decision = self.decide_value(value)
+            if decision:
                 return True
         return False
 
-    def __call__(self, frame, event, arg) -> Optional[Tracer]:
-        if event == "call":
-            frame.f_trace_opcodes = True
-            return self
-        elif event != "opcode":
-            return None
+    def decide_type(self, tp: type) -> Tuple[Optional[bool], bool]:
+        """
+        Decides whether to trace all values of a type, if their module only depends
+        on their type.
+        """
+        has_dict = bool(getattr(tp, "__dictoffset__", 0))
+        if issubclass(
+            tp,
+            (
+                types.ModuleType,
+                types.BuiltinMethodType,
+                types.MethodDescriptorType,
+                types.MethodType,
+            ),
+        ):
+            return None, has_dict
+        for klass in tp.__mro__:
+            if isinstance(klass.__dict__.get("__getattribute__"), types.FunctionType):
+                return None, has_dict
+            if "__module__" in klass.__dict__:
+                module = klass.__dict__["__module__"]
+                if not isinstance(module, str):
+                    # A descriptor, like for functions and classes
+                    return None, has_dict
+                return self.decide_module(module), has_dict
+        if hasattr(tp, "__getattr__"):
+            return None, has_dict
+        return self.decide_module(getmodulename(tp), tp), has_dict
+
+    def decide_value(self, value) -> bool:
+        if isinstance(value, types.BuiltinMethodType):
+            # if this was a method defined in C, use the instance as the value
+            return self.should_trace(value.__self__)
+        if isinstance(value, types.MethodType):
+            # Bound methods are created on each access, so use their function
+            return self.should_trace(value.__func__)
+        if isinstance(value, types.ModuleType):
+            return self.decide_module(value.__name__)
+        key = id(value)
+        entry = self.value_decisions.get(key)
+        if entry and entry[0]() is value:
+            return entry[1]
+
+        decision = self.decide_module(
+            getmodulename(value) or getmodulename(type(value)), value
+        )
+        try:
+            ref = weakref.ref(value, lambda _: self.value_decisions.pop(key, None))
+        except TypeError:
+            # Can't be cached without keeping it alive
+            pass
+        else:
+            self.value_decisions[key] = (ref, decision)
+        return decision
 
-        if self.should_trace_frame(frame):
-            stack = Stack(
-                self,
-                frame,
-                previous_stack=self.previous_stack,
+    def decide_module(self, module: Optional[str], value: object = None) -> bool:
+        if not module:
+            warnings.warn(f"Cannot get module of {value}")
+            return False
+        try:
+            return self.module_decisions[module]
+        except KeyError:
+            decision = self.module_decisions[module] = bool(
+                self.calls_to_modules_pattern.match(module)
             )
-            stack()
-            self.previous_stack = stack if stack.log_call_args else None
+            return decision
+
+    @functools.cached_property
+    def calls_to_modules_pattern(self) -> re.Pattern[str]:
+        # Matches module names starting with any of `calls_to_modules`
+        if not self.calls_to_modules:
+            return re.compile("(?!)")
+        return re.compile("|".join(map(re.escape, self.calls_to_modules)))
+
+    def __call__(self, frame, event, arg) -> Optional[Callable]:
+        # As the global trace function, we are only called on "call" events
+        if not self.active:
+            # A thread started while we were active
+            sys.settrace(None)
+            return None
+        code = frame.f_code
+        try:
+            traced_code = self.code_cache[code]
+        except KeyError:
+            traced_code = self.code_cache[code] = self.create_traced_code(frame)
+        if not traced_code or (traced_code.saturated and not traced_code.rearm()):
+            return None
+        frame.f_trace_opcodes = True
+        return traced_code.local_tracer
+
+    def create_traced_code(self, frame) -> Optional[TracedCode]:
+        if not self.should_trace_frame(frame):
+            return None
+        traced_code = TracedCode(
+            interesting_instructions(frame.f_code, self.opcode_handlers)
+        )
+        traced_code.local_tracer = functools.partial(self.trace_opcode, traced_code)
+        return traced_code
+
+    def trace_opcode(self, code: TracedCode, frame, event, arg) -> None:
+        if event != "opcode":
+            return None
+        if not self.active:
+            frame.f_trace_opcodes = False
+            return None
+        instruction = code.instructions[frame.f_lasti]
+        count = 1
+        if instruction:
+            if SAMPLE and not code.saturated:
+                count = code.sample(frame.f_lasti)
+            if code.saturated or not count:
+                # Skipped, but we may still have to log the previous call
+                instruction = None
+            elif CODE_SATURATION:
+                code.count_execution(frame.f_lasti)
+        stack = self.thread_state.stack
+        if stack is None:
+            stack = self.thread_state.stack = Stack(self)
+        if instruction or stack.pending_call:
+            stack(frame, code, instruction, count)
+        if code.saturated and not stack.pending_call:
+            # Also stop tracing opcodes in frames which are already running
+            frame.f_trace_opcodes = False
         return None
 
+    def flush_counts(self) -> None:
+        # Copy, since code we run may add to the cache if we are still tracing
+        for traced_code in list(self.code_cache.values()):
+            if traced_code:
+                traced_code.flush_counts()
+
+    def forget_logged_calls(self) -> None:
+        for traced_code in list(self.code_cache.values()):
+            if traced_code:
+                traced_code.call_sites.clear()
+                traced_code.sampled_sites.clear()
+                traced_code.reset_saturation()
+
     def should_trace_frame(self, frame) -> bool:
         # Ignore frames which are not from the `calls_from_module`
         try:
@@ -647,13 +1555,626 @@ class Tracer:
         )
 
 
-def setup():
+@dataclasses.dataclass
+class MonitoredCode(TracedCode):
+    # The line number of each instruction, indexed by offset // 2
+    lines: List[Optional[int]] = dataclasses.field(default_factory=list)
+    # How many calls in a row there have been at each offset without a new call
+    repeats: Dict[int, int] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class MonitoringTracer(Tracer):
+    """
+    Traces calls using `sys.monitoring` (PEP 669), from Python 3.12, instead of
+    `sys.settrace`.
+
+    Only `CALL` events are enabled, only for code from `calls_from_modules`, and each
+    call site is disabled once it has gone `SATURATION` calls without a new call.
+
+    `CALL` events only give us the callable and its first argument, so for calls to
+    Python functions we also monitor when the function starts, to get its arguments
+    from its frame, and returns, to get the type it returns. This uses a second
+    tool id, since the first disables `PY_START` for every code object once seen.
+    Calls to other callables, like those defined in C, are not logged, since we
+    can't get all of their arguments.
+    """
+
+    code_cache: Dict[types.CodeType, Optional[MonitoredCode]] = dataclasses.field(  # type: ignore
+        default_factory=dict, repr=False
+    )
+    # The code objects of the functions we monitor starting and returning
+    callee_codes: Set[types.CodeType] = dataclasses.field(
+        default_factory=set, repr=False
+    )
+    # The Python function each callable calls, or `None` if it isn't one
+    callee_functions: Dict[int, Tuple[weakref.ref, Optional[types.FunctionType]]] = (
+        dataclasses.field(default_factory=dict, repr=False)
+    )
+
+    def __post_init__(self):
+        super().__post_init__()
+        if not hasattr(sys, "monitoring"):
+            raise RuntimeError("The monitoring mode requires Python 3.12 or later")
+        self.tool_id = sys.monitoring.PROFILER_ID  # type: ignore
+        self.callee_tool_id: Optional[int] = None
+
+    def __enter__(self):
+        monitoring = sys.monitoring  # type: ignore
+        events = monitoring.events
+        monitoring.use_tool_id(self.tool_id, "record_api")
+        self.callee_tool_id = next(
+            (i for i in range(6) if monitoring.get_tool(i) is None), None
+        )
+        if self.callee_tool_id is None:
+            monitoring.free_tool_id(self.tool_id)
+            raise RuntimeError("No sys.monitoring tool id is free to monitor callees")
+        monitoring.use_tool_id(self.callee_tool_id, "record_api")
+        monitoring.register_callback(self.tool_id, events.PY_START, self.on_py_start)
+        monitoring.register_callback(self.tool_id, events.CALL, self.on_call)
+        monitoring.register_callback(
+            self.callee_tool_id, events.PY_START, self.on_callee_start
+        )
+        monitoring.register_callback(
+            self.callee_tool_id, events.PY_RETURN, self.on_callee_return
+        )
+        self.active = True
+        monitoring.set_events(self.tool_id, events.PY_START)
+        # Code objects we saw last time won't start `PY_START` again, so enable their
+        # events here
+        for code, monitored_code in self.code_cache.items():
+            if monitored_code:
+                monitoring.set_local_events(self.tool_id, code, events.CALL)
+        for code in self.callee_codes:
+            monitoring.set_local_events(
+                self.callee_tool_id, code, events.PY_START | events.PY_RETURN
+            )
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        monitoring = sys.monitoring  # type: ignore
+        self.active = False
+        monitoring.set_events(self.tool_id, 0)
+        for code, monitored_code in self.code_cache.items():
+            if monitored_code:
+                monitoring.set_local_events(self.tool_id, code, 0)
+        for code in self.callee_codes:
+            monitoring.set_local_events(self.callee_tool_id, code, 0)
+        monitoring.free_tool_id(self.tool_id)
+        monitoring.free_tool_id(self.callee_tool_id)
+        self.callee_tool_id = None
+        self.thread_state.expected_call = None
+        self.thread_state.started_calls.clear()
+
+    def on_py_start(self, code: types.CodeType, instruction_offset: int) -> Any:
+        try:
+            monitored_code = self.code_cache[code]
+        except KeyError:
+            # The frame starting is the one calling us
+            monitored_code = self.code_cache[code] = self.create_traced_code(
+                sys._getframe(1)
+            )
+        if monitored_code:
+            sys.monitoring.set_local_events(  # type: ignore
+                self.tool_id, code, sys.monitoring.events.CALL  # type: ignore
+            )
+        # We only need to see each code object start once
+        return sys.monitoring.DISABLE  # type: ignore
+
+    def create_traced_code(self, frame) -> Optional[MonitoredCode]:
+        if not self.should_trace_frame(frame):
+            return None
+        return MonitoredCode(
+            [], lines=[line for line, *_ in frame.f_code.co_positions()]
+        )
+
+    def callee_function(self, callable_: Callable) -> Optional[types.FunctionType]:
+        """
+        Returns the Python function whose frame starts when `callable_` is called,
+        unwrapping methods and decorators, like NumPy's dispatchers, defined in C.
+        """
+        key = id(callable_)
+        entry = self.callee_functions.get(key)
+        if entry and entry[0]() is callable_:
+            return entry[1]
+        fn: Any = getattr(callable_, "__func__", callable_)
+        if not isinstance(fn, types.FunctionType):
+            try:
+                fn = inspect.unwrap(fn)
+            except ValueError:
+                fn = None
+        if not isinstance(fn, types.FunctionType) or fn.__code__.co_flags & (
+            inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+        ):
+            fn = None
+        try:
+            ref = weakref.ref(
+                callable_, lambda _: self.callee_functions.pop(key, None)
+            )
+        except TypeError:
+            # Can't be cached without keeping it alive
+            pass
+        else:
+            self.callee_functions[key] = (ref, fn)
+        return fn
+
+    def on_call(
+        self, code: types.CodeType, instruction_offset: int, fn: Callable, arg0: object
+    ) -> Any:
+        if not self.active:
+            return None
+        monitored_code = self.code_cache[code]
+        assert monitored_code
+        expected_call = None
+        if self.should_trace(fn):
+            callee = self.callee_function(fn)
+            if callee:
+                callee_code = callee.__code__
+                if callee_code not in self.callee_codes:
+                    self.callee_codes.add(callee_code)
+                    events = sys.monitoring.events  # type: ignore
+                    sys.monitoring.set_local_events(  # type: ignore
+                        self.callee_tool_id,
+                        callee_code,
+                        events.PY_START | events.PY_RETURN,
+                    )
+                # Log the function, with `self` as its first argument for methods
+                expected_call = (
+                    code,
+                    callee_code,
+                    monitored_code,
+                    instruction_offset,
+                    f"{code.co_filename}:{monitored_code.lines[instruction_offset // 2]}",
+                    getattr(fn, "__func__", fn),
+                    callee,
+                )
+        self.thread_state.expected_call = expected_call
+        # Reset when the call is logged, in `on_callee_return`
+        repeats = monitored_code.repeats
+        repeats[instruction_offset] = repeats.get(instruction_offset, 0) + 1
+        if repeats[instruction_offset] >= SATURATION:
+            return sys.monitoring.DISABLE  # type: ignore
+        return None
+
+    def on_callee_start(self, code: types.CodeType, instruction_offset: int) -> Any:
+        thread_state = self.thread_state
+        expected_call = thread_state.expected_call
+        if not expected_call or expected_call[1] is not code:
+            return None
+        frame = sys._getframe(1)
+        caller_code, _, *log_args, fn, callee = expected_call
+        if frame.f_back is None or frame.f_back.f_code is not caller_code:
+            # Called from elsewhere, for example by a wrapper
+            return None
+        thread_state.expected_call = None
+        args, kwargs = frame_arguments(frame, callee)
+        thread_state.started_calls.append((frame, *log_args, fn, tuple(args), kwargs))
+        return None
+
+    def on_callee_return(
+        self, code: types.CodeType, instruction_offset: int, value: object
+    ) -> Any:
+        started_calls = self.thread_state.started_calls
+        if not started_calls:
+            return None
+        frame = sys._getframe(1)
+        # Calls which raised never return, so may be left above this one
+        for i in range(len(started_calls) - 1, -1, -1):
+            if started_calls[i][0] is frame:
+                break
+        else:
+            return None
+        _, monitored_code, offset, *log_args = started_calls[i]
+        del started_calls[i:]
+        if type(value) is type and issubclass(value, Exception):  # type: ignore
+            # Don't record exception
+            return None
+        if monitored_code.log(
+            offset,
+            *log_args,
+            return_type=type(value) if type(value) != type else value,
+        ):
+            monitored_code.repeats[offset] = 0
+        return None
+
+
+@dataclasses.dataclass
+class InstrumentTracer(Tracer):
+    """
+    Instead of tracing opcodes, instruments the modules in `calls_from_modules` as
+    they are imported, so that their calls, attribute accesses, subscripts and binary
+    operators log to us while we are active. See `instrument`.
+
+    Only modules imported after this is created are instrumented, and only while it
+    is the last one created, since it replaces the finder of any earlier one.
+    """
+
+    # The state of every instrumented call site, keyed by id
+    sites: TracedCode = dataclasses.field(
+        default_factory=lambda: TracedCode([]), repr=False
+    )
+
+    def __post_init__(self):
+        super().__post_init__()
+        from . import instrument
+
+        sys.meta_path[:] = [
+            finder
+            for finder in sys.meta_path
+            if not isinstance(finder, instrument.InstrumentingFinder)
+        ]
+        sys.meta_path.insert(0, instrument.InstrumentingFinder(self.calls_from_modules))
+
+    def __enter__(self):
+        from . import instrument
+
+        instrument.TRACER = self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        from . import instrument
+
+        instrument.TRACER = None
+
+    def log(
+        self,
+        site: int,
+        location: str,
+        fn: Callable,
+        args: Tuple,
+        kwargs: Mapping[str, Any],
+        *result: Any,
+    ) -> None:
+        """
+        Logs a call, with the type of its `result`, if passed.
+        """
+        return_type = None
+        if result:
+            (value,) = result
+            if type(value) is type and issubclass(value, Exception):
+                # Don't record exception
+                return
+            return_type = type(value) if type(value) != type else value
+        self.sites.log(site, location, fn, args, kwargs, return_type)
+
+    def flush_counts(self) -> None:
+        super().flush_counts()
+        self.sites.flush_counts()
+
+    def forget_logged_calls(self) -> None:
+        super().forget_logged_calls()
+        self.sites.call_sites.clear()
+
+
+def find_function(frame) -> Optional[types.FunctionType]:
+    """
+    Returns the function a frame is executing, looking it up by qualified name from
+    its module or, for methods, on the type of its first argument. For wrappers made
+    by decorators, it is also looked up by the name of a function they close over,
+    which their module binds to the wrapper. Returns `None` if we can't find it, for
+    example for lambdas and nested functions.
+    """
+    code = frame.f_code
+    candidates: List[object] = []
+    qualname = getattr(code, "co_qualname", code.co_name)
+    if "<" not in qualname:
+        candidates.append(lookup_qualname(frame.f_globals, qualname))
+    if code.co_argcount or code.co_freevars:
+        locals_ = frame.f_locals
+    if code.co_argcount:
+        self_ = locals_.get(code.co_varnames[0])
+        for klass in (self_ if isinstance(self_, type) else type(self_)).__mro__:
+            if code.co_name in klass.__dict__:
+                candidates.append(klass.__dict__[code.co_name])
+                break
+    for name in code.co_freevars:
+        wrapped = locals_.get(name)
+        if isinstance(wrapped, types.FunctionType) and "<" not in wrapped.__qualname__:
+            candidates.append(lookup_qualname(wrapped.__globals__, wrapped.__qualname__))
+    for candidate in candidates:
+        # Unwrap static and class methods, and then check each function a decorated
+        # one wraps, since the frame may be of the wrapper or of what it wraps
+        fn = getattr(candidate, "__func__", candidate)
+        seen = set()
+        while fn is not None and id(fn) not in seen:
+            if getattr(fn, "__code__", None) is code:
+                return fn  # type: ignore
+            seen.add(id(fn))
+            fn = getattr(fn, "__wrapped__", None)
+    return None
+
+
+def lookup_qualname(globals_: Mapping[str, Any], qualname: str) -> object:
+    """
+    Returns the object with a qualified name in a module's globals, or `None`.
+    """
+    first, *rest = qualname.split(".")
+    o: object = globals_.get(first)
+    for name in rest:
+        o = getattr(o, name, None)
+    return o
+
+
+def frame_arguments(frame, fn: types.FunctionType) -> Tuple[List, Dict[str, Any]]:
+    """
+    Returns the positional and keyword arguments a function was called with, from
+    the locals of its frame before it has run.
+
+    Arguments which are their default are left out, as if they weren't passed.
+    """
+    code = frame.f_code
+    locals_ = frame.f_locals
+    names = code.co_varnames
+    n_positional = code.co_argcount
+    n_kw_only = code.co_kwonlyargcount
+
+    args = [locals_[name] for name in names[:n_positional]]
+    i = n_positional + n_kw_only
+    varargs: Sequence = ()
+    if code.co_flags & inspect.CO_VARARGS:
+        varargs = locals_[names[i]]
+        i += 1
+    defaults = fn.__defaults__ or ()
+    # Only the last positional arguments can be left out, and only if there are no
+    # more after them
+    while (
+        not varargs
+        and args
+        and len(args) > n_positional - len(defaults)
+        and args[-1] is defaults[len(args) - 1 - (n_positional - len(defaults))]
+    ):
+        args.pop()
+    args.extend(varargs)
+
+    kw_defaults = fn.__kwdefaults__ or {}
+    kwargs = {
+        name: locals_[name]
+        for name in names[n_positional : n_positional + n_kw_only]
+        if name not in kw_defaults or locals_[name] is not kw_defaults[name]
+    }
+    if code.co_flags & inspect.CO_VARKEYWORDS:
+        kwargs.update(locals_[names[i]])
+    return args, kwargs
+
+
+# The opcodes frames return from, when they don't raise
+RETURN_OPCODES = {
+    dis.opmap[opname]
+    for opname in ("RETURN_VALUE", "RETURN_CONST")
+    if opname in dis.opmap
+}
+
+
+@dataclasses.dataclass
+class ProfileTracer(Tracer):
+    """
+    Only traces function calls, using `sys.setprofile` instead of tracing opcodes.
+
+    Calls to Python functions are logged with the arguments from the called frame,
+    leaving out those which are their defaults, and with the type they return, unless
+    they raise. Profiling doesn't give us the arguments or results of functions
+    defined in C, so those are not logged. Generators and coroutines are not logged
+    either.
+    """
+
+    # The function executing each code object, or `None` if we can't find it, for
+    # code which isn't a closure
+    functions: Dict[types.CodeType, Optional[types.FunctionType]] = dataclasses.field(
+        default_factory=dict, repr=False
+    )
+
+    def __enter__(self):
+        self.active = True
+        threading.setprofile(self)
+        sys.setprofile(self)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.active = False
+        sys.setprofile(None)
+        threading.setprofile(None)  # type: ignore
+
+    def __call__(self, frame, event, arg) -> None:
+        if not self.active:
+            # A thread started while we were active
+            sys.setprofile(None)
+        elif event == "call":
+            self.on_call(frame)
+        elif event == "return":
+            self.on_return(frame, arg)
+
+    def traced_code(self, frame) -> Optional[TracedCode]:
+        code = frame.f_code
+        try:
+            return self.code_cache[code]
+        except KeyError:
+            traced_code = self.code_cache[code] = self.create_traced_code(frame)
+            return traced_code
+
+    def create_traced_code(self, frame) -> Optional[TracedCode]:
+        if not self.should_trace_frame(frame):
+            return None
+        return TracedCode([])
+
+    def on_call(self, frame) -> None:
+        caller = frame.f_back
+        if caller is None:
+            return
+        traced_code = self.traced_code(caller)
+        if not traced_code:
+            return
+        code = frame.f_code
+        if code.co_flags & (
+            inspect.CO_GENERATOR | inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR
+        ):
+            # These are called each time they resume
+            return
+        if code.co_freevars:
+            # Each closure over this code is another function, like the wrappers
+            # a decorator makes
+            fn = find_function(frame)
+        else:
+            try:
+                fn = self.functions[code]
+            except KeyError:
+                fn = self.functions[code] = find_function(frame)
+        if fn is None or not self.should_trace(fn):
+            return
+        args, kwargs = frame_arguments(frame, fn)
+        self.thread_state.pending_calls[id(frame)] = (
+            traced_code,
+            caller.f_lasti,
+            f"{caller.f_code.co_filename}:{caller.f_lineno}",
+            fn,
+            tuple(args),
+            kwargs,
+        )
+
+    def on_return(self, frame, value: object) -> None:
+        pending_call = self.thread_state.pending_calls.pop(id(frame), None)
+        if not pending_call:
+            return
+        if frame.f_code.co_code[frame.f_lasti] not in RETURN_OPCODES:
+            # Raised, so `value` is `None`
+            return
+        if type(value) is type and issubclass(value, Exception):  # type: ignore
+            # Don't record exception
+            return
+        traced_code, *log_args = pending_call
+        traced_code.log(
+            *log_args, return_type=type(value) if type(value) != type else value
+        )
+
+
+TRACERS: Dict[str, Type[Tracer]] = {
+    "opcodes": Tracer,
+    "monitoring": MonitoringTracer,
+    "instrument": InstrumentTracer,
+    "calls": ProfileTracer,
+}
+
+
+def output_path() -> str:
+    """
+    Returns the path to write to, which is a shard of `PYTHON_RECORD_API_OUTPUT_FILE`
+    in processes started by the one which first called `setup`.
+    """
+    path = os.environ["PYTHON_RECORD_API_OUTPUT_FILE"]
+    # Set in the environment, so processes we start inherit it
+    main_pid = os.environ.setdefault("PYTHON_RECORD_API_MAIN_PID", str(os.getpid()))
+    if main_pid != str(os.getpid()):
+        return jsonl.shard_path(path, str(os.getpid()))
+    return path
+
+
+def setup(path: Optional[str] = None, aggregate: bool = AGGREGATE) -> None:
+    """
+    Opens the output file, at `path` or by default at `output_path()`.
+
+    If `aggregate` is set, writes the rows grouped like `line_counts` instead.
+    """
     global write_line, context_manager
-    FILE_NAME = os.environ["PYTHON_RECORD_API_OUTPUT_FILE"]
-    context_manager = jsonl.write(FILE_NAME, default=default)
+    # Always compute the default, so we register as the main process if first
+    default_path = output_path()
+    FILE_NAME = path or default_path
+    if FILE_NAME == os.environ.get("PYTHON_RECORD_API_OUTPUT_FILE"):
+        # We are the main process, so any shards are from an earlier run
+        jsonl.remove_shards(FILE_NAME)
+    if aggregate:
+        # Imported here, so running `line_counts` as a module doesn't import it twice
+        from . import line_counts
+
+        # Write the grouped rows, as `line_counts` would, instead of the raw rows
+        context_manager = line_counts.aggregate(
+            FILE_NAME, AGGREGATE_MAX_SIZE, default=default
+        )
+    elif QUEUE_SIZE:
+        if BACKPRESSURE not in ("block", "drop"):
+            raise ValueError(
+                f"PYTHON_RECORD_API_BACKPRESSURE must be 'block' or 'drop', not {BACKPRESSURE!r}"
+            )
+        context_manager = jsonl.write_in_background(
+            FILE_NAME, QUEUE_SIZE, drop=BACKPRESSURE == "drop", default=default
+        )
+    else:
+        context_manager = jsonl.write(FILE_NAME, default=default)
     write_line = context_manager.__enter__()
 
 
 def finalize():
+    global write_line, context_manager
     assert context_manager
-    context_manager.__exit__(*sys.exc_info())
+    with _paused():
+        if TRACER:
+            TRACER.flush_counts()
+        context_manager.__exit__(*sys.exc_info())
+    write_line = context_manager = None
+
+
+@contextlib.contextmanager
+def _paused() -> Iterator[None]:
+    """
+    Stops tracing in this thread, so that we don't trace our own bookkeeping in
+    processes forked while tracing.
+    """
+    if not TRACER or not TRACER.active:
+        yield
+        return
+    trace, profile = sys.gettrace(), sys.getprofile()
+    TRACER.active = False
+    try:
+        yield
+    finally:
+        TRACER.active = True
+        sys.settrace(trace)
+        sys.setprofile(profile)
+
+
+# The outputs of the parent process, which forked processes keep references to so
+# they are never closed or cleaned up from the forked process.
+_parent_context_managers: List[ContextManager] = []
+
+
+def _flush_before_fork() -> None:
+    # Flush so the forked process doesn't inherit, and maybe write, buffered rows
+    flush = getattr(write_line, "flush", None)
+    if flush:
+        flush()
+
+
+def _setup_after_fork() -> None:
+    """
+    Writes to a new shard in processes forked while tracing.
+    """
+    if not context_manager:
+        return
+    _parent_context_managers.append(context_manager)
+    with _paused():
+        if TRACER:
+            # Log the calls again in this process' shard
+            TRACER.forget_logged_calls()
+        setup(
+            jsonl.shard_path(
+                os.environ["PYTHON_RECORD_API_OUTPUT_FILE"], str(os.getpid())
+            )
+        )
+    atexit.register(_finalize_after_fork)
+    if "multiprocessing" in sys.modules:
+        import multiprocessing.util
+
+        # `multiprocessing` exits forked processes without running `atexit` hooks,
+        # and clears finalizers before running its own after fork hooks
+        multiprocessing.util.register_after_fork(
+            _finalize_after_fork, _register_multiprocessing_finalizer
+        )
+
+
+def _register_multiprocessing_finalizer(_) -> None:
+    import multiprocessing.util
+
+    multiprocessing.util.Finalize(None, _finalize_after_fork, exitpriority=100)
+
+
+def _finalize_after_fork() -> None:
+    if context_manager:
+        finalize()
+
+
+os.register_at_fork(before=_flush_before_fork, after_in_child=_setup_after_fork)
@@ -46,13 +46,17 @@ def parse_line(
     function: object,
     params=None,
     bound_params=None,
-    return_type: typing.Optional[typing.Dict[str, typing.Union[str, typing.Dict]]] = None
+    return_type: typing.Optional[typing.Dict[str, typing.Union[str, typing.Dict]]] = None,
+    calls: typing.Optional[int] = None,
 ) -> typing.Optional[API]:
     if bound_params is not None:
         signature = Signature.from_bound_params(**bound_params, return_type=return_type)
     else:
         signature = Signature.from_params(**params, return_type=return_type)
     signature.metadata[f"usage.{LABEL}"] = n
+    # Rows grouped before calls were counted don't have them
+    if calls is not None:
+        signature.metadata[f"calls.{LABEL}"] = calls
     return process_function(create_type(function), s=signature)
 
 
@@ -0,0 +1,482 @@
+"""
+Instruments modules as they are imported, so that their calls, attribute
+accesses, subscripts and binary operators go through the probes below, instead
+of tracing every opcode.
+
+Calls are still made from the instrumented frame, so functions which look at
+their caller's frame, like `warnings.warn` with a `stacklevel`, see the same one.
+Where assignment expressions aren't allowed, in class bodies and in the iterables
+of comprehensions, calls are made from the `call` and `call_method` probes instead.
+
+Used by the "instrument" mode, see `core.InstrumentTracer`.
+"""
+from __future__ import annotations
+
+import ast
+import importlib.abc
+import importlib.machinery
+import itertools
+import operator as op
+import sys
+import types
+from typing import *
+
+if TYPE_CHECKING:
+    from .core import InstrumentTracer
+
+__all__ = ["InstrumentingFinder", "Instrumenter"]
+
+# The tracer to log to, while one is active
+TRACER: Optional[InstrumentTracer] = None
+
+# The name instrumented modules import this module as
+PROBES_NAME = "__record_api_probes__"
+# The name instrumented calls assign their prepared call to
+CALL_NAME = "__record_api_call__"
+
+# Calls to these builtins depend on the frame they are called from, so they
+# have to be left alone.
+FRAME_SENSITIVE_BUILTINS = {"super", "locals", "vars", "globals", "dir", "eval", "exec"}
+
+BINARY_OPERATORS: Dict[Type[ast.operator], Callable] = {
+    ast.Add: op.add,
+    ast.Sub: op.sub,
+    ast.Mult: op.mul,
+    ast.MatMult: op.matmul,
+    ast.Div: op.truediv,
+    ast.FloorDiv: op.floordiv,
+    ast.Mod: op.mod,
+    ast.Pow: op.pow,
+    ast.LShift: op.lshift,
+    ast.RShift: op.rshift,
+    ast.BitOr: op.or_,
+    ast.BitXor: op.xor,
+    ast.BitAnd: op.and_,
+}
+INPLACE_OPERATORS: Dict[Type[ast.operator], Callable] = {
+    ast.Add: op.iadd,
+    ast.Sub: op.isub,
+    ast.Mult: op.imul,
+    ast.MatMult: op.imatmul,
+    ast.Div: op.itruediv,
+    ast.FloorDiv: op.ifloordiv,
+    ast.Mod: op.imod,
+    ast.Pow: op.ipow,
+    ast.LShift: op.ilshift,
+    ast.RShift: op.irshift,
+    ast.BitOr: op.ior,
+    ast.BitXor: op.ixor,
+    ast.BitAnd: op.iand,
+}
+OPERATORS_BY_NAME = {
+    fn.__name__: fn
+    for fn in itertools.chain(BINARY_OPERATORS.values(), INPLACE_OPERATORS.values())
+}
+
+# Ids for the call sites we instrument, unique across modules
+site_ids = itertools.count()
+
+# Used for the slices in instrumented subscripts, since modules can shadow `slice`
+slice = slice
+
+
+def prepare_call(fn: Callable, /, *args, **kwargs) -> List:
+    """
+    Returns the callable, arguments and keyword arguments for an instrumented call
+    to make, and the function and arguments to log it with, for `called`.
+    """
+    return [fn, args, kwargs, fn, args]
+
+
+def prepare_call_method(self_: object, name: str, /, *args) -> List:
+    """
+    Like `prepare_call` for a method, logging the function from the type with `self_`
+    as the first argument if there is one, like the `CALL_METHOD` opcode.
+    """
+    bound = getattr(self_, name)
+    method = getattr(type(self_), name, None)
+    if getattr(bound, "__self__", None) is self_ and (
+        (isinstance(method, types.FunctionType) and bound.__func__ is method)  # type: ignore
+        or (
+            isinstance(method, types.MethodDescriptorType)
+            and isinstance(bound, types.BuiltinMethodType)
+        )
+    ):
+        return [bound, args, {}, method, (self_, *args)]
+    return [bound, args, {}, bound, args]
+
+
+def called(site: int, location: str, call_: List, result: object) -> Any:
+    """
+    Logs a call made from the instrumented frame, prepared by `prepare_call` or
+    `prepare_call_method`, and returns its result.
+    """
+    _, _, kwargs, fn, args = call_
+    # Don't keep the arguments alive in the instrumented frame
+    call_.clear()
+    tracer = TRACER
+    if tracer and tracer.should_trace(fn):
+        tracer.log(site, location, fn, args, kwargs, result)
+    return result
+
+
+def call(site: int, location: str, fn: Callable, /, *args, **kwargs) -> Any:
+    call_ = prepare_call(fn, *args, **kwargs)
+    return called(site, location, call_, call_[0](*call_[1], **call_[2]))
+
+
+def call_method(site: int, location: str, self_: object, name: str, /, *args) -> Any:
+    call_ = prepare_call_method(self_, name, *args)
+    return called(site, location, call_, call_[0](*call_[1]))
+
+
+def getattr_(site: int, location: str, o: object, name: str) -> Any:
+    result = getattr(o, name)
+    tracer = TRACER
+    if tracer and tracer.should_trace(o):
+        tracer.log(site, location, getattr, (o, name), {}, result)
+    return result
+
+
+def getitem(site: int, location: str, o: object, key: object) -> Any:
+    result = o[key]  # type: ignore
+    tracer = TRACER
+    if tracer and tracer.should_trace(o):
+        tracer.log(site, location, op.getitem, (o, key), {}, result)
+    return result
+
+
+def binop(site: int, location: str, name: str, left: object, right: object) -> Any:
+    operator = OPERATORS_BY_NAME[name]
+    result = operator(left, right)
+    tracer = TRACER
+    if tracer and tracer.should_trace(left, right):
+        tracer.log(site, location, operator, (left, right), {})
+    return result
+
+
+def setattr_binop(
+    site: int, location: str, op_site: int, name: str, o: object, attr: str, right: object
+) -> None:
+    """
+    An augmented assignment to an attribute, which only evaluates `o` once. Unlike
+    the statement, `right` is evaluated before the attribute is loaded.
+    """
+    left = getattr_(site, location, o, attr)
+    setattr(o, attr, binop(op_site, location, name, left, right))
+
+
+def setitem_binop(
+    site: int, location: str, op_site: int, name: str, o: object, key: object, right: object
+) -> None:
+    """
+    Like `setattr_binop` for an augmented assignment to a subscript.
+    """
+    left = getitem(site, location, o, key)
+    o[key] = binop(op_site, location, name, left, right)  # type: ignore
+
+
+class Instrumenter(ast.NodeTransformer):
+    """
+    Rewrites a module's expressions into calls to the probes in this module.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        # Nodes to leave alone, because they are annotations, which may be
+        # stringified, or patterns, which can't contain calls
+        self.skip: Set[int] = set()
+        # Whether we can make calls from the instrumented frame here, which needs
+        # an assignment expression
+        self.inline = True
+        # Whether we are in the iterable of a comprehension, where even lambdas
+        # can't have assignment expressions
+        self.in_iterable = False
+
+    def visit(self, node: ast.AST) -> Any:
+        if id(node) in self.skip:
+            return node
+        return super().visit(node)
+
+    def probe(
+        self,
+        node: ast.AST,
+        name: str,
+        *args: ast.expr,
+        keywords: Sequence[ast.keyword] = (),
+    ) -> ast.Call:
+        return ast.copy_location(
+            ast.Call(
+                func=self.probe_function(name),
+                args=[
+                    ast.Constant(value=next(site_ids)),
+                    ast.Constant(value=f"{self.filename}:{node.lineno}"),  # type: ignore
+                    *args,
+                ],
+                keywords=list(keywords),
+            ),
+            node,
+        )
+
+    @staticmethod
+    def probe_function(name: str) -> ast.Attribute:
+        return ast.Attribute(
+            value=ast.Name(id=PROBES_NAME, ctx=ast.Load()), attr=name, ctx=ast.Load()
+        )
+
+    def visit_Module(self, node: ast.Module) -> ast.Module:
+        for child in ast.walk(node):
+            if isinstance(child, (ast.AnnAssign, ast.arg)) and child.annotation:
+                self.skip.add(id(child.annotation))
+            elif (
+                isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef))
+                and child.returns
+            ):
+                self.skip.add(id(child.returns))
+            elif type(child).__name__ == "match_case":
+                self.skip.add(id(child.pattern))  # type: ignore
+        self.generic_visit(node)
+        # Import the probes after the docstring and `__future__` imports
+        i = 0
+        if (
+            node.body
+            and isinstance(node.body[0], ast.Expr)
+            and isinstance(node.body[0].value, ast.Constant)
+            and isinstance(node.body[0].value.value, str)
+        ):
+            i = 1
+        while (
+            i < len(node.body)
+            and isinstance(node.body[i], ast.ImportFrom)
+            and node.body[i].module == "__future__"  # type: ignore
+        ):
+            i += 1
+        node.body.insert(
+            i, ast.Import(names=[ast.alias(name=__name__, asname=PROBES_NAME)])
+        )
+        return ast.fix_missing_locations(node)
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in FRAME_SENSITIVE_BUILTINS:
+            self.generic_visit(node)
+            return node
+        if (
+            isinstance(func, ast.Attribute)
+            and not self.is_private(func.attr)
+            and not node.keywords
+            and not any(isinstance(arg, ast.Starred) for arg in node.args)
+        ):
+            # Compiled to `LOAD_METHOD` and `CALL_METHOD`
+            name = "call_method"
+            args = [
+                self.visit(func.value),
+                ast.Constant(value=func.attr),
+                *(self.visit(arg) for arg in node.args),
+            ]
+        else:
+            self.generic_visit(node)
+            name = "call"
+            args = [node.func, *node.args]
+        if not self.inline:
+            return self.probe(node, name, *args, keywords=node.keywords)
+        # `called(site, location, (call := prepare_call(f, *args)), call[0](*call[1], **call[2]))`
+        # so the call is made from this frame
+        prepared = ast.NamedExpr(
+            target=ast.Name(id=CALL_NAME, ctx=ast.Store()),
+            value=ast.Call(
+                func=self.probe_function(f"prepare_{name}"),
+                args=args,
+                keywords=node.keywords,
+            ),
+        )
+        inline_call = ast.Call(
+            func=self.call_item(0),
+            args=[ast.Starred(value=self.call_item(1), ctx=ast.Load())],
+            keywords=[ast.keyword(arg=None, value=self.call_item(2))],
+        )
+        return self.probe(node, "called", prepared, inline_call)
+
+    @staticmethod
+    def call_item(i: int) -> ast.Subscript:
+        index: Any = ast.Constant(value=i)
+        if sys.version_info < (3, 9):
+            index = ast.Index(value=index)  # type: ignore
+        return ast.Subscript(
+            value=ast.Name(id=CALL_NAME, ctx=ast.Load()), slice=index, ctx=ast.Load()
+        )
+
+    def visit_FunctionDef(self, node: ast.AST) -> ast.AST:
+        return self.visit_scope(node, inline=True)
+
+    visit_AsyncFunctionDef = visit_FunctionDef
+
+    def visit_Lambda(self, node: ast.Lambda) -> ast.AST:
+        return self.visit_scope(node, inline=not self.in_iterable)
+
+    def visit_ClassDef(self, node: ast.ClassDef) -> ast.AST:
+        # Assignment expressions in class bodies would also set class attributes
+        return self.visit_scope(node, inline=False)
+
+    def visit_scope(self, node: ast.AST, inline: bool) -> ast.AST:
+        """
+        Visits the body of a function, lambda or class, with `inline` set, and the
+        rest of it, like decorators and defaults, in the enclosing scope.
+        """
+        body = node.body  # type: ignore
+        node.body = []  # type: ignore
+        self.generic_visit(node)
+        outer_inline, self.inline = self.inline, inline
+        if isinstance(body, list):
+            module = ast.Module(body=body, type_ignores=[])
+            self.generic_visit(module)
+            node.body = module.body  # type: ignore
+        else:
+            node.body = self.visit(body)  # type: ignore
+        self.inline = outer_inline
+        return node
+
+    def visit_comprehension(self, node: ast.comprehension) -> ast.AST:
+        # Assignment expressions aren't allowed in the iterables of comprehensions
+        outer = self.inline, self.in_iterable
+        self.inline, self.in_iterable = False, True
+        node.target = self.visit(node.target)
+        node.iter = self.visit(node.iter)
+        self.inline, self.in_iterable = outer
+        node.ifs = [self.visit(if_) for if_ in node.ifs]
+        return node
+
+    def visit_Attribute(self, node: ast.Attribute) -> ast.AST:
+        self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load) or self.is_private(node.attr):
+            return node
+        return self.probe(node, "getattr_", node.value, ast.Constant(value=node.attr))
+
+    def visit_Subscript(self, node: ast.Subscript) -> ast.AST:
+        self.generic_visit(node)
+        if not isinstance(node.ctx, ast.Load):
+            return node
+        return self.probe(node, "getitem", node.value, self.slice_value(node.slice))
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        self.generic_visit(node)
+        return self.probe(
+            node,
+            "binop",
+            ast.Constant(value=BINARY_OPERATORS[type(node.op)].__name__),
+            node.left,
+            node.right,
+        )
+
+    def visit_AugAssign(self, node: ast.AugAssign) -> ast.AST:
+        # Only the expressions in the target are visited, since it is stored to
+        self.generic_visit(node)
+        name = ast.Constant(value=INPLACE_OPERATORS[type(node.op)].__name__)
+        target = node.target
+        if isinstance(target, ast.Name):
+            # `x += y` to `x = binop(site, location, "iadd", x, y)`
+            value = self.probe(
+                node, "binop", name, ast.Name(id=target.id, ctx=ast.Load()), node.value
+            )
+            return ast.copy_location(ast.Assign(targets=[target], value=value), node)
+        op_site = ast.Constant(value=next(site_ids))
+        if isinstance(target, ast.Attribute) and not self.is_private(target.attr):
+            probe = self.probe(
+                node,
+                "setattr_binop",
+                op_site,
+                name,
+                target.value,
+                ast.Constant(value=target.attr),
+                node.value,
+            )
+        elif isinstance(target, ast.Subscript):
+            probe = self.probe(
+                node,
+                "setitem_binop",
+                op_site,
+                name,
+                target.value,
+                self.slice_value(target.slice),
+                node.value,
+            )
+        else:
+            return node
+        return ast.copy_location(ast.Expr(value=probe), node)
+
+    @staticmethod
+    def is_private(name: str) -> bool:
+        # Private names are mangled by the compiler, so can't be used as strings
+        return name.startswith("__") and not name.endswith("__")
+
+    def slice_value(self, node: ast.AST) -> ast.expr:
+        """
+        Turns the slice of a subscript into an expression for the key it passes.
+        """
+        if isinstance(node, ast.Slice):
+            return ast.copy_location(
+                ast.Call(
+                    func=self.probe_function("slice"),
+                    args=[
+                        part or ast.Constant(value=None)
+                        for part in (node.lower, node.upper, node.step)
+                    ],
+                    keywords=[],
+                ),
+                node,
+            )
+        if isinstance(node, ast.Tuple):
+            return ast.copy_location(
+                ast.Tuple(elts=[self.slice_value(elt) for elt in node.elts], ctx=ast.Load()),
+                node,
+            )
+        # Before Python 3.9, slices are wrapped in their own nodes
+        if isinstance(node, getattr(ast, "Index", ())):
+            return self.slice_value(node.value)  # type: ignore
+        if isinstance(node, getattr(ast, "ExtSlice", ())):
+            return ast.copy_location(
+                ast.Tuple(elts=[self.slice_value(dim) for dim in node.dims], ctx=ast.Load()),  # type: ignore
+                node,
+            )
+        return node  # type: ignore
+
+
+class InstrumentingLoader(importlib.machinery.SourceFileLoader):
+    def get_code(self, fullname: str) -> types.CodeType:
+        # Skip the bytecode cache, which isn't instrumented
+        path = self.get_filename(fullname)
+        return self.source_to_code(self.get_data(path), path)
+
+    def source_to_code(self, data, path, *, _optimize=-1):  # type: ignore
+        tree = Instrumenter(path).visit(ast.parse(data, path))
+        return compile(tree, path, "exec", dont_inherit=True, optimize=_optimize)
+
+
+class InstrumentingFinder(importlib.abc.MetaPathFinder):
+    """
+    Finds modules in `modules` with the other finders, but loads them with
+    `InstrumentingLoader` when they are from source files.
+    """
+
+    def __init__(self, modules: List[str]):
+        self.modules = modules
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname.startswith(f"{__package__}.") or not any(
+            fullname == mod or fullname.startswith(mod + ".") for mod in self.modules
+        ):
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        # Other loaders, like pytest's assertion rewriting hook for test modules,
+        # compile the modules themselves, so they aren't instrumented
+        if type(spec.loader) is importlib.machinery.SourceFileLoader:
+            spec.loader = InstrumentingLoader(spec.loader.name, spec.loader.path)
+        return spec
+
@@ -1,60 +1,668 @@
-import subprocess
+import bz2
+import collections
+import concurrent.futures
 import dataclasses
 import contextlib
+import functools
+import glob
+import gzip
+import lzma
+import mmap
+import os
 import orjson
+import sys
+import queue
+import threading
 import tqdm
 import typing
 import io
+import types
+from stat import S_ISREG
 import warnings
 
+from . import binary
 
-__all__ = ["read", "write"]
+
+__all__ = [
+    "read",
+    "read_chunks",
+    "write",
+    "Writer",
+    "write_in_background",
+    "BackgroundWriter",
+    "CompressingFile",
+    "shard_path",
+    "with_shards",
+]
+
+
+# The modules to compress files with, by their extension
+COMPRESSIONS: typing.Dict[str, types.ModuleType] = {
+    ".gz": gzip,
+    ".bz2": bz2,
+    ".xz": lzma,
+}
+
+
+def split_compression(path: str) -> typing.Tuple[str, typing.Optional[types.ModuleType]]:
+    """
+    Returns `path` without its compression extension, if it has one, and the
+    module to compress it with.
+    """
+    stem, extension = os.path.splitext(path)
+    module = COMPRESSIONS.get(extension)
+    if module is None:
+        return path, None
+    return stem, module
+
+
+# The path to read from stdin or write to stdout, so stages can be piped together
+STDIO = "-"
+
+# How many bytes to read at once
+BLOCK_SIZE = 2 ** 20
+
+
+class ProgressFile(io.RawIOBase):
+    """
+    Wraps a file being read, to update `progress` with the bytes read from it.
+    """
+
+    def __init__(self, file: io.RawIOBase, progress: tqdm.tqdm):
+        super().__init__()
+        self.file = file
+        self.progress = progress
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> typing.Optional[int]:
+        n = self.file.readinto(b)
+        if n:
+            self.progress.update(n)
+        return n
+
+    def close(self) -> None:
+        self.file.close()
+        super().close()
 
 
 @contextlib.contextmanager
-def read(path: str) -> typing.Iterator[typing.Iterable[dict]]:
+def read(path: str, progress: bool = True) -> typing.Iterator[typing.Iterable[dict]]:
+    """
+    Reads the rows of a JSONL file, or of a binary file, see `binary`. Files with
+    an extension in `COMPRESSIONS` are decompressed as they are read.
 
-    print("Counting lines...")
+    `path` can also be a pipe, or `STDIO` to read from stdin. If `progress` is set,
+    progress is shown as the bytes read, out of the size of the file if it has one.
+    """
+    with open_input(path, progress) as stream:
+        # Read instead of peeking, since pipes may return less
+        head = stream.read(len(binary.MAGIC))
+        if head == binary.MAGIC:
+            yield binary.read(stream)
+        else:
+            yield read_lines(head, stream)
 
-    n = lines_in_file(path)
 
-    file = io.FileIO(path, "r")
-    buffer = io.BufferedReader(file)
-    stream = io.TextIOWrapper(buffer)  # type: ignore
-    yield read_lines(path, n, stream)
+@contextlib.contextmanager
+def open_input(path: str, progress: bool = True) -> typing.Iterator[typing.BinaryIO]:
+    """
+    Opens a file to read, decompressing it, and showing progress, like `read`.
+    """
+    if path == STDIO:
+        file = io.FileIO(sys.stdin.fileno(), "r", closefd=False)
+    else:
+        file = io.FileIO(path, "r")
+    stat = os.fstat(file.fileno())
+    bar = tqdm.tqdm(
+        total=stat.st_size if S_ISREG(stat.st_mode) else None,
+        desc=f"reading {path}",
+        unit="B",
+        unit_scale=True,
+        disable=not progress,
+    )
+    buffer = io.BufferedReader(ProgressFile(file, bar), BLOCK_SIZE)
+    stream: typing.BinaryIO = buffer  # type: ignore
+    _, module = split_compression(path)
+    if module is not None:
+        stream = module.open(buffer, "rb")
+    yield stream
+    # Closing the decompressed stream doesn't close the file it reads
     stream.close()
     buffer.close()
-    file.close()
+    bar.close()
+
+
+def dumps_function(path: str, **kwargs) -> typing.Callable[[dict], bytes]:
+    """
+    Returns a function to serialize each row written to `path`, passing `kwargs`
+    to `orjson.dumps`.
+
+    Paths ending in `binary.BINARY_EXTENSION`, before any compression extension, are
+    written in the binary format, whose rows have to be written in the order they
+    are serialized.
+    """
+    if split_compression(path)[0].endswith(binary.BINARY_EXTENSION):
+        return binary.Encoder(**kwargs)
+    return lambda o: orjson.dumps(o, **kwargs) + b"\n"
+
+
+def read_lines(head: bytes, stream: typing.BinaryIO) -> typing.Iterable[dict]:
+    """
+    Yields the rows of a JSONL stream, which starts with `head`, reading it in
+    large blocks.
+    """
+    rest = head
+    while True:
+        block = stream.read(BLOCK_SIZE)
+        lines = (rest + block).split(b"\n")
+        rest = lines.pop() if block else b""
+        yield from decode_lines(lines)
+        if not block:
+            return
 
 
-def read_lines(path, n: int, stream: io.TextIOWrapper) -> typing.Iterable[dict]:
-    for _ in tqdm.trange(n, desc=f"reading {path}"):
-        line = stream.readline()
+def decode_lines(lines: typing.Iterable[bytes]) -> typing.Iterable[dict]:
+    for line in lines:
         try:
             yield orjson.loads(line)
         except orjson.JSONDecodeError:
-            warnings.warn(f"Could not decode line:\n{line}")
+            if line.strip():
+                warnings.warn(f"Could not decode line:\n{line.decode(errors='replace')}")
+
+
+# How many bytes of a file each worker of `read_chunks` reads at once
+CHUNK_SIZE = 2 ** 26
+
+T = typing.TypeVar("T")
+
+
+def read_chunks(
+    path: str,
+    reduce: typing.Callable[[typing.Iterable[dict]], T],
+    workers: typing.Optional[int] = None,
+    chunk_size: typing.Optional[int] = None,
+) -> typing.Iterator[T]:
+    """
+    Reads the rows of a JSONL file in parallel, yielding `reduce` of the rows of
+    each chunk, in order.
+
+    The file is split into chunks of about `chunk_size` bytes, by default
+    `CHUNK_SIZE`, that end on newlines. Each chunk is read and reduced in one of
+    `workers` processes, so only the results are sent back. `reduce` has to be
+    picklable, like a module level function.
+
+    Regular files are memory mapped by each worker, so they are sent only the
+    offsets of their chunk. Inputs which can't be mapped, like compressed files
+    and pipes, are read in this process and the chunks sent to the workers.
+    Binary files can't be split, so they are read and reduced whole, here.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    chunk_size = chunk_size or CHUNK_SIZE
+    ranges = chunk_ranges(path, chunk_size)
+    if ranges is not None:
+        with tqdm.tqdm(
+            total=ranges[-1][1] if ranges else 0,
+            desc=f"reading {path}",
+            unit="B",
+            unit_scale=True,
+        ) as progress:
+            results = map_in_processes(
+                functools.partial(reduce_chunk, path, reduce), ranges, workers
+            )
+            for (start, end), result in zip(ranges, results):
+                yield result
+                progress.update(end - start)
+        return
+    with open_input(path) as stream:
+        head = stream.read(len(binary.MAGIC))
+        if head == binary.MAGIC:
+            yield reduce(binary.read(stream))
+            return
+        yield from map_in_processes(
+            functools.partial(reduce_lines, reduce),
+            read_line_chunks(head, stream, chunk_size),
+            workers,
+        )
+
+
+def map_in_processes(
+    fn: typing.Callable[[typing.Any], T], items: typing.Iterable, workers: int
+) -> typing.Iterator[T]:
+    """
+    Yields `fn` of each item, in order, calling it in `workers` processes.
+
+    Only a few items more than there are workers are sent at once, so that they
+    can be read lazily.
+    """
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    pending: typing.Deque[concurrent.futures.Future] = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for item in items:
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_line_chunks(
+    head: bytes, stream: typing.BinaryIO, chunk_size: int
+) -> typing.Iterator[bytes]:
+    """
+    Yields chunks of about `chunk_size` bytes of a JSONL stream, which starts
+    with `head`, each ending after a newline or at the end of the stream.
+    """
+    rest = head
+    while True:
+        block = stream.read(chunk_size)
+        if not block:
+            if rest:
+                yield rest
+            return
+        data = rest + block
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+
+
+def reduce_lines(reduce: typing.Callable[[typing.Iterable[dict]], T], data: bytes) -> T:
+    return reduce(decode_lines(data.split(b"\n")))
+
+
+def chunk_ranges(
+    path: str, chunk_size: int
+) -> typing.Optional[typing.List[typing.Tuple[int, int]]]:
+    """
+    Returns the start and end offsets of the chunks of a JSONL file, each ending
+    after a newline or at the end of the file, or None if it can't be mapped.
+    """
+    if path == STDIO or split_compression(path)[1] is not None:
+        return None
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        if not S_ISREG(stat.st_mode):
+            return None
+        if not stat.st_size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[: len(binary.MAGIC)] == binary.MAGIC:
+                return None
+            ranges = []
+            start = 0
+            while start < len(mm):
+                end = mm.find(b"\n", start + chunk_size - 1) + 1 or len(mm)
+                ranges.append((start, end))
+                start = end
+            return ranges
+
+
+def reduce_chunk(
+    path: str,
+    reduce: typing.Callable[[typing.Iterable[dict]], T],
+    range_: typing.Tuple[int, int],
+) -> T:
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return reduce(read_range(mm, *range_))
+
+
+def read_range(mm: mmap.mmap, start: int, end: int) -> typing.Iterable[dict]:
+    """
+    Yields the rows between two offsets of a mapped file, which should be at the
+    starts of lines.
+
+    Only about `BLOCK_SIZE` bytes of the file are copied out of the map at once.
+    """
+    pos = start
+    while pos < end:
+        stop = min(pos + BLOCK_SIZE, end)
+        if stop < end:
+            # End the block after its last newline, or after the next one for lines
+            # longer than a block
+            newline = mm.rfind(b"\n", pos, stop)
+            if newline < 0:
+                newline = mm.find(b"\n", stop, end)
+            stop = newline + 1 if newline >= 0 else end
+        yield from decode_lines(mm[pos:stop].split(b"\n"))
+        pos = stop
+
+
+def open_raw(path: str) -> io.RawIOBase:
+    """
+    Opens `path` for writing, compressing it on a background thread if it has an
+    extension in `COMPRESSIONS`. `STDIO` writes to stdout.
+    """
+    if path == STDIO:
+        return io.FileIO(sys.stdout.fileno(), "w", closefd=False)
+    _, module = split_compression(path)
+    if module is None:
+        return io.FileIO(path, "w")
+    return CompressingFile(path, module)
+
+
+class CompressingFile(io.RawIOBase):
+    """
+    A file which passes what is written to it to a background thread, which
+    compresses it with `module` and writes it to `path`.
+
+    The compressors release the GIL, so this doesn't stall the traced program.
+    Errors from the thread are raised on the next write, or on close.
+    """
+
+    # How many writes can be waiting to be compressed
+    MAX_QUEUE_SIZE = 64
+
+    def __init__(self, path: str, module: types.ModuleType):
+        super().__init__()
+        self.file = module.open(path, "wb")
+        self.error: typing.Optional[BaseException] = None
+        self.queue: queue.Queue = queue.Queue(self.MAX_QUEUE_SIZE)
+        self.thread = threading.Thread(
+            target=self.run, name="record_api.jsonl.CompressingFile", daemon=True
+        )
+        self.thread.start()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if self.error is not None:
+            raise self.error
+        # Copy, since the caller may reuse the buffer
+        self.queue.put(bytes(b))
+        return len(b)
+
+    def run(self) -> None:
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                if self.error is None:
+                    try:
+                        self.file.write(data)
+                    except BaseException as e:
+                        # Keep draining the queue so the writer doesn't block
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    def flush(self) -> None:
+        """
+        Waits for everything written to be compressed and flushed to the file.
+        """
+        if self.closed:
+            return
+        self.queue.join()
+        if self.error is None:
+            self.file.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            # Flushes first
+            super().close()
+        finally:
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+# How many bytes each thread buffers before writing to the file
+THREAD_BUFFER_SIZE = 2 ** 16
+
+
+class Writer:
+    """
+    Writes rows to a JSONL file, passing `kwargs` to `orjson.dumps`.
+
+    Each thread serializes rows on its own and appends them to its own buffer,
+    without a lock, and only takes the lock to write the buffer to the file once it
+    is full, so that rows from different threads are not interleaved. Binary files
+    are written under the lock instead, since their rows depend on the rows before.
+    """
+
+    def __init__(self, path: str, **kwargs):
+        self.dumps = dumps_function(path, **kwargs)
+        self.binary = isinstance(self.dumps, binary.Encoder)
+        self.file = open_raw(path)
+        self.buffer = io.BufferedWriter(self.file)
+        if self.binary:
+            self.buffer.write(binary.MAGIC)
+        self.lock = threading.Lock()
+        # The buffer of each thread, so `flush` can write them, with the thread
+        self.thread_buffers: typing.List[
+            typing.Tuple[threading.Thread, bytearray]
+        ] = []
+        self.local = threading.local()
+
+    def __call__(self, o: dict) -> None:
+        if self.binary:
+            with self.lock:
+                self.buffer.write(self.dumps(o))
+            return
+        row = self.dumps(o)
+        try:
+            thread_buffer = self.local.buffer
+        except AttributeError:
+            thread_buffer = self.local.buffer = bytearray()
+            with self.lock:
+                self.thread_buffers.append((threading.current_thread(), thread_buffer))
+        # Appending a whole row is atomic under the GIL, so `write_buffer` from
+        # another thread only ever sees whole rows
+        thread_buffer += row
+        if len(thread_buffer) >= THREAD_BUFFER_SIZE:
+            with self.lock:
+                self.write_buffer(thread_buffer)
+
+    def write_buffer(self, thread_buffer: bytearray) -> None:
+        # Only remove what we write, since its thread may append more meanwhile
+        data = bytes(thread_buffer)
+        self.buffer.write(data)
+        del thread_buffer[: len(data)]
+
+    def flush(self) -> None:
+        """
+        Writes all buffered rows to the file.
+        """
+        with self.lock:
+            thread_buffers = self.thread_buffers
+            # Threads which exited won't append again, so forget them once written.
+            # Check first, so we write what they appended before exiting.
+            self.thread_buffers = [
+                (thread, thread_buffer)
+                for thread, thread_buffer in thread_buffers
+                if thread.is_alive()
+            ]
+            for _, thread_buffer in thread_buffers:
+                self.write_buffer(thread_buffer)
+            self.buffer.flush()
+            self.file.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self.buffer.close()
+        self.file.close()
 
 
 @contextlib.contextmanager
-def write(path: str, **kwargs) -> typing.Iterator[typing.Callable[[dict], None]]:
-    file = io.FileIO(path, "w")
-    buffer = io.BufferedWriter(file)
+def write(path: str, **kwargs) -> typing.Iterator[Writer]:
+    writer = Writer(path, **kwargs)
+    yield writer
+    writer.close()
 
-    def write_line(o: dict, buffer=buffer) -> None:
-        buffer.write(orjson.dumps(o, **kwargs))
-        buffer.write(b"\n")
 
-    yield write_line
-    buffer.close()
-    file.close()
+class BackgroundWriter:
+    """
+    Writes rows to a JSONL file from a background thread, so that the caller
+    doesn't wait on serialization or I/O.
+
+    Rows are passed to the thread on a queue of at most `max_queue_size` rows.
+    When it is full, we either block until there is space or, if `drop` is set,
+    drop the row and count it in `dropped`. Rows can't be written once closed.
+    """
+
+    # How many rows to serialize and write at once
+    BATCH_SIZE = 1000
+
+    def __init__(self, path: str, max_queue_size: int, drop: bool = False, **kwargs):
+        self.dumps = dumps_function(path, **kwargs)
+        self.drop = drop
+        self.dropped = 0
+        self.written = 0
+        self.error: typing.Optional[BaseException] = None
+        self.closed = False
+        self.queue: queue.Queue = queue.Queue(max_queue_size)
+        self.file = open_raw(path)
+        self.buffer = io.BufferedWriter(self.file)
+        if isinstance(self.dumps, binary.Encoder):
+            self.buffer.write(binary.MAGIC)
+        self.thread = threading.Thread(
+            target=self.run, name="record_api.jsonl.BackgroundWriter", daemon=True
+        )
+        self.thread.start()
+
+    def __call__(self, o: dict) -> None:
+        if self.closed:
+            # Nothing reads the queue any more, so we could block forever
+            raise ValueError("Writing to a closed BackgroundWriter")
+        if not self.drop:
+            self.queue.put(o)
+            return
+        try:
+            self.queue.put_nowait(o)
+        except queue.Full:
+            self.dropped += 1
+
+    def call_soon(self, fn: typing.Callable[[], object]) -> bool:
+        """
+        Calls `fn` from the background thread, after the rows written before it,
+        so the caller can hand it other work.
+
+        Returns False if it won't be called, because the writer is closed or, if
+        `drop` is set, the queue is full.
+        """
+        if self.closed:
+            return False
+        if not self.drop:
+            self.queue.put(fn)
+            return True
+        try:
+            self.queue.put_nowait(fn)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self) -> None:
+        batch: typing.List[typing.Any] = []
+        done = False
+        while not done:
+            batch.append(self.queue.get())
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            n_items = len(batch)
+            if batch[-1] is None:
+                # `close` puts `None` on the queue as the last row
+                batch.pop()
+                done = True
+            rows = [o for o in batch if isinstance(o, dict)]
+            if self.error is None:
+                try:
+                    self.buffer.write(b"".join(map(self.dumps, rows)))
+                    for o in batch:
+                        if not isinstance(o, dict):
+                            o()
+                except BaseException as e:
+                    # Keep draining the queue so the caller doesn't block, and
+                    # raise on close
+                    self.error = e
+                else:
+                    self.written += len(rows)
+            batch.clear()
+            for _ in range(n_items):
+                self.queue.task_done()
+
+    def flush(self) -> None:
+        """
+        Waits for all queued rows to be written to the file.
+        """
+        self.queue.join()
+        self.buffer.flush()
+        self.file.flush()
+
+    def close(self) -> None:
+        """
+        Waits for all queued rows to be written and closes the file.
+        """
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.buffer.close()
+        self.file.close()
+        if self.dropped:
+            warnings.warn(
+                f"Dropped {self.dropped} rows out of {self.dropped + self.written} "
+                "because the writer queue was full"
+            )
+        if self.error is not None:
+            raise self.error
+
+
+@contextlib.contextmanager
+def write_in_background(
+    path: str, max_queue_size: int, drop: bool = False, **kwargs
+) -> typing.Iterator[BackgroundWriter]:
+    """
+    Like `write`, but writes from a background thread, see `BackgroundWriter`.
+    """
+    writer = BackgroundWriter(path, max_queue_size, drop, **kwargs)
+    yield writer
+    writer.close()
+
+
+def shard_path(path: str, shard: str) -> str:
+    """
+    Returns the path of a shard of the file at `path`, for example `raw.shard-1.jsonl`
+    for `raw.jsonl`, so processes tracing the same program don't overwrite each other.
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.shard-{shard}{dot}{extensions}")
+
+
+def with_shards(path: str) -> typing.List[str]:
+    """
+    Returns `path`, if it exists, and the paths of all of its shards.
+    """
+    if path == STDIO:
+        return [path]
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    pattern = os.path.join(
+        glob.escape(directory),
+        f"{glob.escape(stem)}.shard-*{glob.escape(dot + extensions)}",
+    )
+    paths = [path] if os.path.exists(path) else []
+    return paths + sorted(glob.glob(pattern))
 
 
-def lines_in_file(filename: str) -> int:
+def remove_shards(path: str) -> None:
     """
-    https://gist.github.com/zed/0ac760859e614cd03652#file-gistfile1-py-L41
+    Removes the shards of `path` left over from earlier runs, so they aren't read
+    with the shards of this one.
     """
-    out = subprocess.Popen(
-        ["wc", "-l", filename], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
-    ).communicate()[0]
-    return int(out.lstrip().partition(b" ")[0])
+    for shard in with_shards(path):
+        if shard != path:
+            os.remove(shard)
@@ -3,39 +3,582 @@ Aggregate outputs by line count.
 """
 from __future__ import annotations
 
-import collections
+import array
+import bisect
+import concurrent.futures
+import contextlib
 import csv
 import dataclasses
+import functools
+import hashlib
+import heapq
 import json
 import re
+import shutil
+import tempfile
 import typing
 import operator
 import os
+import sys
+import zlib
 
 import tqdm
 import orjson
 
 from . import jsonl
 
-INPUT = os.environ["PYTHON_RECORD_API_INPUT"]
-OUTPUT = os.environ["PYTHON_RECORD_API_OUTPUT"]
+__all__ = ["Calls", "PartitionedCalls", "aggregate", "group", "group_in_parallel"]
 
 
-def __main__():
+class Locations:
+    """
+    Interns locations, like `path/to/file.py:123`, as ids, keeping each file
+    path once.
+    """
+
+    # Locations without a line number are stored whole as the path
+    NO_LINE = 0
+
+    def __init__(self):
+        self.path_ids: typing.Dict[str, int] = {}
+        self.paths: typing.List[str] = []
+        # The id of each location, by its path id and line number packed in one
+        # int, and the packed location of each id
+        self.ids: typing.Dict[int, int] = {}
+        self.packed = array.array("Q")
+        # Rough number of bytes taken by the paths and locations
+        self.size = 0
+
+    def id(self, location: str) -> int:
+        path, _, line = location.rpartition(":")
+        # Only pack lines which fit and print back the same
+        if (
+            path
+            and line.isdigit()
+            and line.isascii()
+            and len(line) < 10
+            and (line[0] != "0" or len(line) == 1)
+        ):
+            packed = int(line) + 1
+        else:
+            path, packed = location, self.NO_LINE
+        path_id = self.path_ids.get(path)
+        if path_id is None:
+            path_id = self.path_ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.size += len(path)
+        packed |= path_id << 32
+        id_ = self.ids.get(packed)
+        if id_ is None:
+            id_ = self.ids[packed] = len(self.packed)
+            self.packed.append(packed)
+            self.size += self.packed.itemsize
+        return id_
+
+    def location(self, id_: int) -> str:
+        packed = self.packed[id_]
+        path = self.paths[packed >> 32]
+        line_number = packed & 0xFFFFFFFF
+        if line_number == self.NO_LINE:
+            return path
+        return f"{path}:{line_number - 1}"
+
+
+class Calls:
+    """
+    Conceptual mapping of {function, params} to set of locations, and how many
+    times it was called.
+
+    Each group is found by a 128 bit digest of its row bytes, which are kept in
+    one side table. Its locations are kept as a sorted array of ids, see
+    `Locations`.
+    """
+
+    def __init__(self):
+        # The index of each group, by the digest of its row bytes
+        self.indices: typing.Dict[bytes, int] = {}
+        # The row bytes of all groups, one after the other, and where each ends
+        self.row_data = bytearray()
+        self.row_ends = array.array("Q")
+        # The location ids of each group
+        self.locations: typing.List[array.array] = []
+        # How many times each group was called, from the `count` of its rows
+        self.calls = array.array("Q")
+        self.location_table = Locations()
+        # Rough number of bytes taken by the keys and location ids
+        self.groups_size = 0
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    @property
+    def size(self) -> int:
+        """
+        Rough number of bytes taken by the groups and the locations.
+        """
+        return self.groups_size + self.location_table.size
+
+    def add(self, row: dict, **kwargs) -> int:
+        """
+        Adds a raw row, passing `kwargs` to `orjson.dumps`, returning the index of
+        its group.
+        """
+        return self.add_locations(
+            row_key(row, **kwargs), (row["location"],), row.get("count", 1)
+        )
+
+    def add_locations(
+        self, row_bytes: bytes, locations: typing.Iterable[str], calls: int
+    ) -> int:
+        """
+        Adds locations and `calls` to the group of `row_bytes`, returning its index.
+        New groups are added at the end.
+        """
+        digest = hashlib.blake2b(row_bytes, digest_size=16).digest()
+        i = self.indices.get(digest)
+        if i is None:
+            i = self.indices[digest] = len(self.locations)
+            self.row_data += row_bytes
+            self.row_ends.append(len(self.row_data))
+            self.locations.append(array.array("I"))
+            self.calls.append(0)
+            self.groups_size += len(digest) + len(row_bytes) + self.calls.itemsize
+        self.calls[i] += calls
+        existing = self.locations[i]
+        location_id = self.location_table.id
+        for location in locations:
+            id_ = location_id(location)
+            # New locations get the largest ids, so are usually added at the end
+            if not existing or id_ > existing[-1]:
+                existing.append(id_)
+            else:
+                j = bisect.bisect_left(existing, id_)
+                if existing[j] == id_:
+                    continue
+                existing.insert(j, id_)
+            self.groups_size += existing.itemsize
+        return i
+
+    def row_bytes(self, i: int) -> bytes:
+        return bytes(self.row_data[self.row_ends[i - 1] if i else 0 : self.row_ends[i]])
+
+    def groups(self) -> typing.Iterator[typing.Tuple[bytes, typing.List[str], int]]:
+        """
+        Yields the row bytes, the locations and the number of calls of each group.
+        """
+        location = self.location_table.location
+        for i, ids in enumerate(self.locations):
+            yield self.row_bytes(i), [location(id_) for id_ in ids], self.calls[i]
+
+    def rows(self) -> typing.Iterable[dict]:
+        """
+        Returns the grouped rows, with `n` being the number of locations and
+        `calls` the number of calls.
+        """
+        for i in tqdm.trange(len(self), desc="writing"):
+            row_ = orjson.loads(self.row_bytes(i))
+            row_["n"] = len(self.locations[i])
+            row_["calls"] = self.calls[i]
+            yield row_
+
+    def clear(self) -> None:
+        self.indices.clear()
+        self.row_data = bytearray()
+        self.row_ends = array.array("Q")
+        self.locations.clear()
+        self.calls = array.array("Q")
+        self.location_table = Locations()
+        self.groups_size = 0
+
+
+def row_key(row: dict, **kwargs) -> bytes:
+    """
+    Returns the bytes to group a raw row by, passing `kwargs` to `orjson.dumps`.
+    """
+    # Dump so we can hash.
+    # How many more times the tracer saw the call is summed into `calls`
+    return orjson.dumps(
+        {k: v for k, v in row.items() if k not in ("location", "count")},
+        option=orjson.OPT_SORT_KEYS,
+        **kwargs,
+    )
+
+
+# How many files to spill rows to, by the hash of their key
+PARTITIONS = 16
+
+
+def partition_index(row_bytes: bytes, n_partitions: int, depth: int = 0) -> int:
+    """
+    Returns which of `n_partitions` to spill a row to, by its key. Each `depth` uses
+    the next digit of the same hash, so that a partition which is still too large
+    can be split again.
+    """
+    return zlib.crc32(row_bytes) // n_partitions ** depth % n_partitions
+
+
+def can_split(n_partitions: int, depth: int) -> bool:
+    """
+    Returns whether the hash has digits left to split a partition at `depth` by.
+    """
+    return n_partitions ** depth <= 0xFFFFFFFF
+
+
+class PartitionedCalls:
+    """
+    Groups rows like `Calls`, but whenever the groups take more than `max_size`
+    bytes, spills them to `n_partitions` files, by default `PARTITIONS`, by the
+    hash of their key, in a temporary directory in `dir`.
+
+    Each partition is then grouped on its own, so only about `1 / n_partitions`
+    of the groups are in memory at once, and a partition which still takes more than
+    `max_size` bytes is split again, see `group_partition`. The grouped rows are
+    merged back in the order of their first row, so they are the same as from
+    `Calls`.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        dir: typing.Optional[str] = None,
+        n_partitions: typing.Optional[int] = None,
+    ):
+        self.calls = Calls()
+        self.max_size = max_size
+        self.dir = dir
+        self.n_partitions = n_partitions or PARTITIONS
+        # The index of the next row, and of the first row of each group in memory
+        self.n_rows = 0
+        self.first = array.array("Q")
+        # Created on the first spill
+        self.spill_dir: typing.Optional[str] = None
+        self.partitions: typing.List[jsonl.Writer] = []
+
+    def add(self, row: dict, **kwargs) -> None:
+        """
+        Adds a raw row, passing `kwargs` to `orjson.dumps`.
+        """
+        i = self.calls.add(row, **kwargs)
+        if i == len(self.first):
+            self.first.append(self.n_rows)
+        self.n_rows += 1
+        if self.calls.size > self.max_size:
+            self.spill()
+
+    def partition_path(self, i: int) -> str:
+        assert self.spill_dir
+        return partition_path(self.spill_dir, i)
+
+    def spill(self) -> None:
+        if self.spill_dir is None:
+            # Don't use `TemporaryDirectory`, so that forked processes, which
+            # never group these rows, never remove it
+            self.spill_dir = tempfile.mkdtemp(prefix=".record_api-", dir=self.dir)
+            self.partitions = [
+                jsonl.Writer(self.partition_path(i)) for i in range(self.n_partitions)
+            ]
+        groups = zip(self.first, self.calls.groups())
+        for first, (row_bytes, locations, n_calls) in groups:
+            self.partitions[partition_index(row_bytes, self.n_partitions)](
+                {
+                    "row": row_bytes.decode(),
+                    "first": first,
+                    "locations": locations,
+                    "calls": n_calls,
+                }
+            )
+        # Flush so that forked processes don't inherit spilled rows
+        for partition in self.partitions:
+            partition.flush()
+        self.calls.clear()
+        self.first = array.array("Q")
+
+    def spill_all(self) -> str:
+        """
+        Spills all the groups and closes the partitions, returning the directory
+        they are in.
+        """
+        self.spill()
+        for partition in self.partitions:
+            partition.close()
+        assert self.spill_dir
+        return self.spill_dir
 
-    # Conceptual mapping of {function, params} to set of locations
-    calls: typing.DefaultDict[bytes, typing.Set[str]] = collections.defaultdict(set)
-    with jsonl.read(INPUT) as f:
-        for row in f:
-            location = row.pop("location")
-            # Dump so we can hash
-            calls[orjson.dumps(row, option=orjson.OPT_SORT_KEYS)].add(location)
-
-    with jsonl.write(OUTPUT) as write:
-        for row_bytes, locations in tqdm.tqdm(calls.items(), "writing"):
-            row_ = orjson.loads(row_bytes)
-            row_["n"] = len(locations)
-            write(row_)
+    def rows(self) -> typing.Iterable[dict]:
+        """
+        Returns the grouped rows, like `Calls.rows`.
+        """
+        if self.spill_dir is None:
+            yield from self.calls.rows()
+            return
+        self.spill_all()
+        paths = [self.partition_path(i) for i in range(self.n_partitions)]
+        for path in tqdm.tqdm(paths, desc="grouping partitions"):
+            group_partition([(path, 0)], path, self.max_size, self.n_partitions)
+        yield from merge_runs(paths)
+        shutil.rmtree(self.spill_dir)
+
+
+def partition_path(spill_dir: str, i: int) -> str:
+    return os.path.join(spill_dir, f"partition-{i}.jsonl")
+
+
+def group_partition(
+    spills: typing.Sequence[typing.Tuple[str, int]],
+    path: str,
+    max_size: typing.Optional[int] = None,
+    n_partitions: int = PARTITIONS,
+    depth: int = 1,
+) -> None:
+    """
+    Groups the rows spilled to a partition, in each of `spills`, a path and how
+    many rows came before it, and writes them to `path` in the order of their
+    first row.
+
+    If the groups take more than `max_size` bytes, the partition is split into
+    `n_partitions` by the next digit of the hash of their key, see
+    `partition_index`, and each of those is grouped the same way, `depth` being how
+    many times it was split.
+    """
+    calls = Calls()
+    first = array.array("Q")
+    rows = spilled_rows(spills)
+    for row_bytes, row_first, locations, n_calls in rows:
+        i = calls.add_locations(row_bytes, locations, n_calls)
+        # Spilled first, so it's the earliest
+        if i == len(first):
+            first.append(row_first)
+        if (
+            max_size is not None
+            and calls.size > max_size
+            and can_split(n_partitions, depth)
+        ):
+            split_partition(calls, first, rows, path, max_size, n_partitions, depth)
+            return
+    with jsonl.write(path) as write:
+        for i in sorted(range(len(first)), key=first.__getitem__):
+            write(
+                {
+                    "first": first[i],
+                    "row": calls.row_bytes(i).decode(),
+                    "n": len(calls.locations[i]),
+                    "calls": calls.calls[i],
+                }
+            )
+
+
+def spilled_rows(
+    spills: typing.Sequence[typing.Tuple[str, int]]
+) -> typing.Iterator[typing.Tuple[bytes, int, typing.List[str], int]]:
+    """
+    Yields the row bytes, the index of the first row, the locations and the number
+    of calls of each spilled group, see `group_partition`.
+    """
+    for spill_path, offset in spills:
+        # Spills are read in workers, so don't show a progress bar for each
+        with jsonl.read(spill_path, progress=False) as spilled:
+            for spilled_row in spilled:
+                yield (
+                    spilled_row["row"].encode(),
+                    spilled_row["first"] + offset,
+                    spilled_row["locations"],
+                    spilled_row["calls"],
+                )
+
+
+def split_partition(
+    calls: Calls,
+    first: array.array,
+    rows: typing.Iterator[typing.Tuple[bytes, int, typing.List[str], int]],
+    path: str,
+    max_size: int,
+    n_partitions: int,
+    depth: int,
+) -> None:
+    """
+    Spills the groups so far, and the rest of the `rows`, of a partition which is
+    too large to `n_partitions` at `depth`, groups each of them, and merges them to
+    `path`.
+    """
+    spill_dir = tempfile.mkdtemp(prefix=".record_api-", dir=os.path.dirname(path))
+    paths = [partition_path(spill_dir, i) for i in range(n_partitions)]
+    with contextlib.ExitStack() as stack:
+        partitions = [stack.enter_context(jsonl.write(path_)) for path_ in paths]
+        for row_first, (row_bytes, locations, n_calls) in zip(first, calls.groups()):
+            partitions[partition_index(row_bytes, n_partitions, depth)](
+                {
+                    "row": row_bytes.decode(),
+                    "first": row_first,
+                    "locations": locations,
+                    "calls": n_calls,
+                }
+            )
+        calls.clear()
+        for row_bytes, row_first, locations, n_calls in rows:
+            partitions[partition_index(row_bytes, n_partitions, depth)](
+                {
+                    "row": row_bytes.decode(),
+                    "first": row_first,
+                    "locations": locations,
+                    "calls": n_calls,
+                }
+            )
+    for path_ in paths:
+        group_partition([(path_, 0)], path_, max_size, n_partitions, depth + 1)
+    with jsonl.write(path) as write:
+        for grouped in merge_grouped(paths):
+            write(grouped)
+    shutil.rmtree(spill_dir)
+
+
+def merge_grouped(paths: typing.Iterable[str]) -> typing.Iterator[dict]:
+    """
+    Merges grouped partitions, from `group_partition`, in the order of their first
+    row.
+    """
+    with contextlib.ExitStack() as stack:
+        runs = [stack.enter_context(jsonl.read(path, progress=False)) for path in paths]
+        yield from heapq.merge(*runs, key=operator.itemgetter("first"))
+
+
+def merge_runs(paths: typing.Iterable[str]) -> typing.Iterator[dict]:
+    """
+    Merges grouped partitions, from `group_partition`, into the grouped rows in
+    the order of their first row.
+    """
+    for grouped in merge_grouped(paths):
+        row_ = orjson.loads(grouped["row"])
+        row_["n"] = grouped["n"]
+        row_["calls"] = grouped["calls"]
+        yield row_
+
+
+@dataclasses.dataclass
+class GroupChunk:
+    """
+    Groups the rows of a chunk of an input in a worker of `jsonl.read_chunks`,
+    spilling them all to partitions in a new directory in `dir`.
+
+    Returns how many rows the chunk had and the directory.
+    """
+
+    dir: str
+    max_size: int
+    n_partitions: int
+
+    def __call__(self, rows: typing.Iterable[dict]) -> typing.Tuple[int, str]:
+        calls = PartitionedCalls(self.max_size, self.dir, self.n_partitions)
+        for row in rows:
+            calls.add(row)
+        return calls.n_rows, calls.spill_all()
+
+
+def group_in_parallel(
+    input_paths: typing.Iterable[str],
+    workers: int,
+    max_size: typing.Optional[int] = None,
+    dir: typing.Optional[str] = None,
+) -> typing.Iterator[dict]:
+    """
+    Yields the grouped rows of all the input files, like `Calls.rows`, using
+    `workers` processes.
+
+    Chunks of the inputs are grouped in parallel and spilled to partitions by
+    the hash of their key. Then the partitions are grouped in parallel, merging
+    the groups from all the chunks, and merged back in the order of their first
+    row. Each worker spills its groups once they take more than `max_size` bytes,
+    and splits the partitions which take more than that again, see
+    `group_partition`.
+    """
+    spill_dir = tempfile.mkdtemp(prefix=".record_api-", dir=dir)
+    n_partitions = PARTITIONS
+    group_chunk = GroupChunk(
+        spill_dir, sys.maxsize if max_size is None else max_size, n_partitions
+    )
+    # The directory of each chunk and how many rows came before it
+    chunks: typing.List[typing.Tuple[str, int]] = []
+    n_rows = 0
+    for path in input_paths:
+        for chunk_rows, chunk_dir in jsonl.read_chunks(path, group_chunk, workers):
+            chunks.append((chunk_dir, n_rows))
+            n_rows += chunk_rows
+    run_paths = [partition_path(spill_dir, i) for i in range(n_partitions)]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        results = executor.map(
+            group_partition,
+            [
+                [(partition_path(chunk_dir, i), offset) for chunk_dir, offset in chunks]
+                for i in range(n_partitions)
+            ],
+            run_paths,
+            [max_size] * n_partitions,
+        )
+        for _ in tqdm.tqdm(results, desc="grouping partitions", total=n_partitions):
+            pass
+    yield from merge_runs(run_paths)
+    shutil.rmtree(spill_dir)
+
+
+@contextlib.contextmanager
+def aggregate(
+    path: str, max_size: int, **kwargs
+) -> typing.Iterator[typing.Callable[[dict], None]]:
+    """
+    Like `jsonl.write`, but groups the raw rows written in memory and writes the
+    grouped rows on exit, as `__main__` would from the raw rows.
+
+    Whenever the grouped rows take more than `max_size` bytes, they are spilled
+    to temporary files next to `path`, see `PartitionedCalls`.
+    """
+    calls = PartitionedCalls(max_size, dir=os.path.dirname(path) or ".")
+    yield functools.partial(calls.add, **kwargs)
+
+    with jsonl.write(path) as write:
+        for row in calls.rows():
+            write(row)
+
+
+def group(
+    input_paths: typing.Iterable[str],
+    output_path: str,
+    max_size: typing.Optional[int] = None,
+    workers: int = 1,
+) -> None:
+    """
+    Groups the raw rows from all the input files and writes them to the output.
+
+    If `max_size` is set, the groups are spilled to disk once they take more than
+    that many bytes, see `PartitionedCalls`. With more than one of `workers`,
+    the rows are grouped in that many processes, see `group_in_parallel`.
+    """
+    dir = None if output_path == jsonl.STDIO else os.path.dirname(output_path) or "."
+    rows: typing.Iterable[dict]
+    if workers > 1:
+        rows = group_in_parallel(input_paths, workers, max_size, dir)
+    else:
+        calls: typing.Union[Calls, PartitionedCalls] = Calls()
+        if max_size is not None:
+            calls = PartitionedCalls(max_size, dir)
+        for path in input_paths:
+            with jsonl.read(path) as f:
+                for row in f:
+                    calls.add(row)
+        rows = calls.rows()
+
+    with jsonl.write(output_path) as write:
+        for row in rows:
+            write(row)
+
+
+def __main__():
+    # Also read the shards written by other processes of the traced program
+    max_size = os.environ.get("PYTHON_RECORD_API_MAX_SIZE")
+    group(
+        jsonl.with_shards(os.environ["PYTHON_RECORD_API_INPUT"]),
+        os.environ["PYTHON_RECORD_API_OUTPUT"],
+        int(max_size) if max_size else None,
+        int(os.environ.get("PYTHON_RECORD_API_WORKERS", "1")),
+    )
 
 
 if __name__ == "__main__":
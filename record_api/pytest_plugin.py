@@ -1,9 +1,18 @@
 import pytest
 import os
 
+from . import jsonl, line_counts
 from .core import *
 
 
+def is_xdist_worker(config) -> bool:
+    return hasattr(config, "workerinput")
+
+
+def is_xdist_controller(config) -> bool:
+    return not is_xdist_worker(config) and getattr(config.option, "dist", "no") != "no"
+
+
 @pytest.hookimpl(hookwrapper=True)
 def pytest_pyfunc_call(pyfuncitem):
     with get_tracer():
@@ -11,12 +20,51 @@ def pytest_pyfunc_call(pyfuncitem):
 
 
 @pytest.hookimpl(hookwrapper=True)
-def pytest_sessionstart(*args):
-    setup()
+def pytest_sessionstart(session):
+    config = session.config
+    if is_xdist_worker(config):
+        # Each worker writes the raw rows to its own shard, which the controller
+        # groups at the end
+        setup(
+            jsonl.shard_path(
+                os.environ["PYTHON_RECORD_API_OUTPUT_FILE"],
+                config.workerinput["workerid"],
+            ),
+            aggregate=False,
+        )
+    elif not is_xdist_controller(config):
+        setup()
+    else:
+        # Before the workers start writing theirs
+        jsonl.remove_shards(os.environ["PYTHON_RECORD_API_OUTPUT_FILE"])
+        yield
+        return
+    # Create the tracer before collecting tests, so that in the "instrument" mode
+    # the modules the tests import are instrumented
+    get_tracer()
     yield
 
 
 @pytest.hookimpl(hookwrapper=True)
-def pytest_sessionfinish(*args):
+def pytest_sessionfinish(session):
     yield
-    finalize()
+    if not is_xdist_controller(session.config):
+        finalize()
+        return
+    # The controller runs no tests, so just merges the workers' shards. The grouped
+    # rows go to their own file, since `line_counts` can't read them again.
+    path = os.environ["PYTHON_RECORD_API_OUTPUT_FILE"]
+    shards = [shard for shard in jsonl.with_shards(path) if shard != path]
+    line_counts.group(shards, grouped_path(path))
+    for shard in shards:
+        os.remove(shard)
+
+
+def grouped_path(path: str) -> str:
+    """
+    Returns the path the controller writes the grouped rows to, for example
+    `raw.grouped.jsonl` for `raw.jsonl`.
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extensions = name.partition(".")
+    return os.path.join(directory, f"{stem}.grouped{dot}{extensions}")
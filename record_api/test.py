@@ -1,12 +1,28 @@
+import ast
+import contextlib
+import functools
+import gc
+import importlib.util
+import inspect
+import itertools
 import operator as op
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+import warnings
 from unittest.mock import call, patch, ANY
 
 import numpy as np
 import pandas as pd
+import orjson
+import threading
 import types
+import typing
+import weakref
 
-from . import Tracer
+from . import ProfileTracer, Tracer, binary, core, instrument, jsonl, line_counts
 
 
 class BaseTest(unittest.TestCase):
@@ -102,13 +118,13 @@ class TestMockNumPyMethod(BaseTest):
 
     def test_tuple_unpack(self):
         self.trace("(*self.a, 10, *self.a)")
-        iter_ = call(ANY, iter, (self.a,))
-        self.assertCalls(iter_, iter_)
+        # Both are at the same offset, so the second is only counted
+        self.assertCalls(call(ANY, iter, (self.a,)))
 
     def test_tuple_unpack_with_call(self):
         self.trace("def f(*args): pass\nf(*self.a, 10, *self.a)")
-        iter_ = call(ANY, iter, (self.a,))
-        self.assertCalls(iter_, iter_)
+        # Both are at the same offset, so the second is only counted
+        self.assertCalls(call(ANY, iter, (self.a,)))
 
     def test_load_attr(self):
         # verify normal object doesn't trigger
@@ -118,6 +134,14 @@ class TestMockNumPyMethod(BaseTest):
             ANY, getattr, (self.a, "shape"), return_type=tuple
         )
 
+    def test_extended_arg(self):
+        # With over 256 names, the attribute's name needs an EXTENDED_ARG prefix
+        names = "".join(f"x{i} = 0\n" for i in range(300))
+        self.trace(f"{names}self.a.shape")
+        self.mock.assert_called_once_with(
+            ANY, getattr, (self.a, "shape"), return_type=tuple
+        )
+
     def test_arange(self):
         self.trace("np.arange(10)")
         self.mock.assert_called_once_with(
@@ -247,6 +271,47 @@ class TestMockNumPyMethod(BaseTest):
             ANY, np.arange, (10,), return_type=np.ndarray
         )
 
+    def test_thread(self):
+        self.trace(
+            "t = threading.Thread(target=lambda: np.arange(10))\nt.start()\nt.join()"
+        )
+        self.mock.assert_called_once_with(
+            ANY, np.arange, (10,), return_type=np.ndarray
+        )
+
+    def test_thread_after_exit(self):
+        started = threading.Event()
+        resume = threading.Event()
+
+        def run():
+            started.set()
+            resume.wait()
+            np.arange(10)
+
+        with self.tracer:
+            t = threading.Thread(target=run)
+            t.start()
+            started.wait()
+        resume.set()
+        t.join()
+        self.mock.assert_not_called()
+
+    def test_code_saturation(self):
+        # The loop saturates, but not the rest of the code
+        with patch.object(core, "CODE_SATURATION", 10):
+            self.trace("for _ in range(50):\n    self.a + 1\nnp.arange(10)")
+        self.assertCalls(
+            call(ANY, op.add, (self.a, 1)),
+            call(ANY, np.arange, (10,), return_type=np.ndarray),
+        )
+
+    def test_opcode_families(self):
+        self.tracer = Tracer(["numpy"], ["record_api.test"], opcodes=["calls"])
+        self.trace("np.arange(10) + self.a.shape[0]")
+        self.mock.assert_called_once_with(
+            ANY, np.arange, (10,), return_type=np.ndarray
+        )
+
 
 class TestMockPandasMethod(BaseTest):
     def setUp(self):
@@ -262,5 +327,814 @@ class TestMockPandasMethod(BaseTest):
         )
 
 
+def caller_code():
+    return sys._getframe(1).f_code
+
+
+class TestInstrumentNumPyMethod(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.a = np.arange(10)
+        self.tracer = core.InstrumentTracer(["numpy"], ["record_api.test"])
+        # Remove the finder it adds
+        self.addCleanup(sys.meta_path.pop, 0)
+
+    def trace(self, source: str):
+        tree = instrument.Instrumenter("<test>").visit(ast.parse(source))
+        namespace = {**globals(), "self": self}
+        with self.tracer:
+            exec(compile(tree, "<test>", "exec"), namespace)
+        return namespace
+
+    def test_arange(self):
+        self.trace("np.arange(10)")
+        self.mock.assert_called_once_with(
+            ANY, np.arange, (10,), return_type=np.ndarray
+        )
+
+    def test_reshape(self):
+        self.trace("self.a.reshape((5, 2))")
+        self.assertCalls(
+            call(ANY, np.ndarray.reshape, (self.a, (5, 2)), return_type=np.ndarray)
+        )
+
+    def test_caller_frame(self):
+        namespace = self.trace("def f():\n    return caller_code()")
+        with self.tracer:
+            self.assertIs(namespace["f"](), namespace["f"].__code__)
+
+    def test_class_body(self):
+        namespace = self.trace(
+            "class A:\n    b = [np.arange(i) for i in range(2)]\n"
+            "c = [i for i in np.arange(2)]"
+        )
+        self.assertNotIn(instrument.CALL_NAME, vars(namespace["A"]))
+        self.assertCalls(
+            call(ANY, np.arange, (0,), return_type=np.ndarray),
+            call(ANY, np.arange, (2,), return_type=np.ndarray),
+        )
+
+    def test_augassign(self):
+        self.trace("a = self.a\na += 1\nself.a *= 2\nself.a[1:3] -= 1")
+        self.assertCalls(
+            call(ANY, op.iadd, (self.a, 1)),
+            call(ANY, op.imul, (self.a, 2)),
+            call(ANY, op.getitem, (self.a, slice(1, 3)), return_type=np.ndarray),
+            call(ANY, op.isub, (ANY, 1)),
+        )
+        np.testing.assert_array_equal(self.a, [2, 3, 5, 8, 10, 12, 14, 16, 18, 20])
+
+    def test_one_finder(self):
+        core.InstrumentTracer(["numpy"], ["record_api.test"])
+        finders = [
+            finder
+            for finder in sys.meta_path
+            if isinstance(finder, instrument.InstrumentingFinder)
+        ]
+        self.assertEqual(len(finders), 1)
+
+
+def with_defaults(a, b=None, *args):
+    return a
+
+
+def raising():
+    raise ValueError()
+
+
+# Wrapped by a function defined in `contextlib`, which we don't trace
+@contextlib.contextmanager
+def decorated(a, b=None):
+    yield a
+
+
+class TestProfileCalls(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.tracer = ProfileTracer(["numpy", "record_api.test"], ["record_api.test"])
+
+    def test_defaults(self):
+        self.trace("with_defaults(1, None)")
+        self.assertCalls(call(ANY, with_defaults, (1,), return_type=int))
+
+    def test_varargs(self):
+        self.trace("with_defaults(1, None, 2)")
+        self.assertCalls(call(ANY, with_defaults, (1, None, 2), return_type=int))
+
+    def test_not_traced_when_exception(self):
+        self.trace("try:\n    raising()\nexcept ValueError:\n    pass")
+        self.mock.assert_not_called()
+
+    def test_c_function_not_logged(self):
+        self.trace("np.add(1, 2)")
+        self.mock.assert_not_called()
+
+    def test_decorated(self):
+        # Logged as the wrapper, with the arguments it was called with
+        self.trace("decorated(1, b=2)\ndecorated(1)")
+        self.assertCalls(
+            call(
+                ANY,
+                decorated,
+                (1,),
+                {"b": 2},
+                return_type=contextlib._GeneratorContextManager,
+            ),
+            call(ANY, decorated, (1,), return_type=contextlib._GeneratorContextManager),
+        )
+
+    @unittest.skipUnless(
+        isinstance(np.ravel, types.FunctionType),
+        "NumPy's dispatched functions are defined in Python before 1.25",
+    )
+    def test_array_function_dispatch(self):
+        self.trace("np.ravel([1, 2, 3])")
+        self.assertCalls(call(ANY, np.ravel, ([1, 2, 3],), return_type=np.ndarray))
+
+
+class TestProfilePandasMethod(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.tracer = ProfileTracer(["pandas"], ["record_api.test"])
+
+    def test_from_records(self):
+        self.trace("pd.DataFrame.from_records([{'hi': 1}])")
+        self.assertCalls(
+            call(
+                ANY,
+                pd.DataFrame.from_records.__func__,
+                (pd.DataFrame, [{"hi": 1}]),
+                return_type=pd.DataFrame,
+            ),
+        )
+
+
+@unittest.skipIf(sys.version_info < (3, 12), "sys.monitoring requires Python 3.12")
+class TestMonitoringNumPyMethod(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.a = np.arange(10)
+        self.tracer = core.MonitoringTracer(["numpy"], ["record_api.test"])
+
+    def test_ravel_list(self):
+        self.trace("np.ravel([1, 2, 3])")
+        self.assertCalls(call(ANY, np.ravel, ([1, 2, 3],), return_type=np.ndarray))
+
+    def test_traced_again(self):
+        self.trace("np.ravel([1, 2, 3])")
+        # Equal code objects share their logged calls, so use another line
+        self.trace("\nnp.ravel([1, 2, 3])")
+        self.assertCalls(
+            call("<string>:1", np.ravel, ([1, 2, 3],), return_type=np.ndarray),
+            call("<string>:2", np.ravel, ([1, 2, 3],), return_type=np.ndarray),
+        )
+
+    def test_repeated_call_logged_once(self):
+        # NumPy's dispatched functions have to be keyed to only be logged once
+        self.trace("for _ in range(3):\n    np.ravel([1, 2, 3])")
+        self.assertCalls(call(ANY, np.ravel, ([1, 2, 3],), return_type=np.ndarray))
+
+    def test_c_function_not_logged(self):
+        # We only get the first argument of calls to functions defined in C
+        self.trace("np.add(self.a, 1)")
+        self.mock.assert_not_called()
+
+    def test_not_traced_when_exception(self):
+        self.trace("try:\n    np.ravel(self.a, order='Z')\nexcept ValueError:\n    pass")
+        self.mock.assert_not_called()
+
+
+@unittest.skipIf(sys.version_info < (3, 12), "sys.monitoring requires Python 3.12")
+class TestMonitoringPandasMethod(BaseTest):
+    def setUp(self):
+        super().setUp()
+        self.tracer = core.MonitoringTracer(["pandas"], ["record_api.test"])
+
+    def test_from_records(self):
+        self.trace("pd.DataFrame.from_records([{'hi': 1}])")
+        self.assertCalls(
+            call(
+                ANY,
+                pd.DataFrame.from_records.__func__,
+                (pd.DataFrame, [{"hi": 1}]),
+                return_type=pd.DataFrame,
+            ),
+        )
+
+
+def old_should_trace(calls_to_modules, *values):
+    """
+    How `Tracer.should_trace` decided, before its decisions were cached.
+    """
+    for value in values:
+        if isinstance(value, types.BuiltinMethodType):
+            value = value.__self__
+        module = core.getmodulename(value) or core.getmodulename(type(value))
+        if not module:
+            continue
+        if any(module.startswith(mod) for mod in calls_to_modules):
+            return True
+    return False
+
+
+class FromModule:
+    def __init__(self, module):
+        self.__module__ = module
+
+    def method(self):
+        pass
+
+
+class TestShouldTrace(unittest.TestCase):
+    def test_old_decisions(self):
+        a = np.arange(3)
+        df = pd.DataFrame({"a": [1]})
+        values = [
+            a,
+            a.sum,
+            np.add,
+            np.add.reduce,
+            np.arange,
+            np.linspace,
+            np,
+            np.ndarray,
+            np.ndarray.sum,
+            np.float64(1),
+            np.dtype("int64"),
+            pd,
+            pd.DataFrame,
+            df,
+            df.sum,
+            pd.DataFrame.from_records,
+            pd.DataFrame.sum,
+            1,
+            "a",
+            None,
+            len,
+            [].append,
+            object(),
+            FromModule("numpy"),
+            FromModule("record_api"),
+            FromModule("numpy").method,
+            lambda: None,
+            functools.partial(np.add, 1),
+            types,
+            self,
+        ]
+        for calls_to_modules in [["numpy"], ["pandas"], ["numpy", "pandas.core"]]:
+            tracer = Tracer(calls_to_modules, [])
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                # Twice, to check the cached decisions
+                for _ in range(2):
+                    for value in values:
+                        with self.subTest(calls_to_modules=calls_to_modules, value=value):
+                            self.assertEqual(
+                                tracer.should_trace(value),
+                                old_should_trace(calls_to_modules, value),
+                            )
+                    for pair in itertools.combinations(values[::3], 2):
+                        self.assertEqual(
+                            tracer.should_trace(*pair),
+                            old_should_trace(calls_to_modules, *pair),
+                        )
+
+
+def signature_bound(fn, args, kwargs):
+    """
+    How `Bound.create` bound arguments, with `inspect.Signature.bind`, before it
+    used `Binder`.
+    """
+    sig = inspect.signature(fn)
+    try:
+        bound = sig.bind(*args, **kwargs)
+    except TypeError:
+        return None
+    b = core.Bound()
+    for k, v in bound.arguments.items():
+        kind = sig.parameters[k].kind
+        if kind == inspect.Parameter.POSITIONAL_ONLY:
+            b.pos_only.append((k, core.preprocess(v)))
+        elif kind == inspect.Parameter.POSITIONAL_OR_KEYWORD:
+            b.pos_or_kw.append((k, core.preprocess(v)))
+        elif kind == inspect.Parameter.VAR_POSITIONAL:
+            b.var_pos = k, core.preprocess(v)
+        elif kind == inspect.Parameter.KEYWORD_ONLY:
+            b.kw_only[k] = core.preprocess(v)
+    return b
+
+
+class TestBinder(unittest.TestCase):
+    def test_signature_bind(self):
+        def no_params():
+            pass
+
+        def positional(a, b=1):
+            pass
+
+        def positional_only(a, b=1, /, c=2):
+            pass
+
+        def keyword_only(a, *, b, c=1):
+            pass
+
+        def var(a, b=1, *args, c=2, **kwargs):
+            pass
+
+        def var_positional_only(a, /, *args, **kwargs):
+            pass
+
+        names = ["a", "b", "c", "args", "kwargs", "d"]
+        fns: typing.List[typing.Callable] = [
+            no_params, positional, positional_only, keyword_only, var, var_positional_only
+        ]
+        for fn in fns:
+            binder = core.create_binder(fn)
+            assert binder
+            for n_args in range(5):
+                args = tuple(range(n_args))
+                for n_kwargs in range(len(names) + 1):
+                    for keywords in itertools.combinations(names, n_kwargs):
+                        kwargs = {name: str(i) for i, name in enumerate(keywords)}
+                        with self.subTest(fn=fn.__name__, args=args, kwargs=kwargs):
+                            self.assertEqual(
+                                binder.bind(args, kwargs),
+                                signature_bound(fn, args, kwargs),
+                            )
+
+    def test_not_kept_alive(self):
+        class Callable:
+            def __call__(self, a):
+                pass
+
+        factories: typing.List[typing.Callable[[], typing.Callable]] = [
+            lambda: functools.partial(with_defaults, 1),
+            Callable,
+        ]
+        for create in factories:
+            fn = create()
+            self.assertIsNotNone(core.get_binder(fn))
+            ref = weakref.ref(fn)
+            del fn
+            gc.collect()
+            self.assertIsNone(ref())
+
+
+class TestPreprocess(unittest.TestCase):
+    def test_truncated(self):
+        int_type = core.primitive_type(int)
+        self.assertEqual(core.preprocess([1, 2]), [int_type, int_type])
+        for n in [11, 1000]:
+            with self.subTest(n=n):
+                self.assertEqual(
+                    core.preprocess(list(range(n))),
+                    {"t": "list", "v": [int_type] * 10, "truncated": True},
+                )
+                self.assertEqual(
+                    core.preprocess(tuple(range(n))),
+                    {"t": "tuple", "v": [int_type] * 10, "truncated": True},
+                )
+                self.assertEqual(
+                    core.preprocess(dict.fromkeys(range(n), "a")),
+                    {"t": "dict", "v": [[int_type, "a"]] * 10, "truncated": True},
+                )
+        # Truncated to the same row, whatever the length
+        self.assertEqual(
+            core.fingerprint(tuple(range(11))), core.fingerprint(tuple(range(1000)))
+        )
+        self.assertNotEqual(
+            core.fingerprint(list(range(10))), core.fingerprint(list(range(11)))
+        )
+
+    def test_homogeneous_shared(self):
+        self.assertIs(
+            core.preprocess((1, 2, 3))["v"], core.preprocess((4, 5, 6))["v"]
+        )
+        self.assertEqual(
+            core.preprocess((1, 2.0, "a")),
+            {
+                "t": "tuple",
+                "v": [core.primitive_type(int), core.primitive_type(float), "a"],
+            },
+        )
+
+
+class TestSample(unittest.TestCase):
+    def test_counted_to_sampled_call(self):
+        code = core.TracedCode([])
+        rows: typing.List[dict] = []
+        with patch.object(core, "SAMPLE", 1), patch.object(
+            core, "SAMPLE_BACKOFF", 2
+        ), patch.object(core, "write_line", rows.append), patch(
+            "record_api.core.log_call",
+            side_effect=lambda location, fn, *args, **kwargs: {"function": fn.__name__},
+        ):
+            # Each traced execution is followed by one more skipped than before. The
+            # third isn't logged, so the executions skipped before it aren't counted.
+            fns: typing.List[typing.Optional[typing.Callable]] = [len, abs, None, len]
+            for fn in fns:
+                while True:
+                    count = code.sample(0)
+                    if count:
+                        break
+                if fn:
+                    code.log(0, "a.py:1", fn, (), {}, count=count)
+            code.sample(0)
+            code.flush_counts()
+        self.assertListEqual(
+            rows,
+            [{"function": "len", "count": 9}, {"function": "abs", "count": 1}],
+        )
+
+
+class TestCallKey(unittest.TestCase):
+    def test_recreated_function(self):
+        def make():
+            return lambda x: x
+
+        self.assertEqual(
+            core.call_key(make(), (make(),), {}, None),
+            core.call_key(make(), (make(),), {}, None),
+        )
+
+    def test_not_kept_alive(self):
+        f = (lambda: lambda x: x)()
+        key = core.call_key(np.add, (f, type("A", (), {})()), {}, type(f))
+        ref = weakref.ref(f)
+        del f
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertIsNotNone(key)
+
+    def test_partial(self):
+        with self.assertRaises(TypeError):
+            core.call_key(functools.partial(np.add, 1), (2,), {}, None)
+
+
+class TestBinary(unittest.TestCase):
+    def test_round_trip(self):
+        rows = [
+            {"location": f"a.py:{i % 3}", "function": {"t": "len"}, "n": i}
+            for i in range(10)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.bin")
+            # Clear the table part of the way through
+            with patch.object(binary, "MAX_TABLE_SIZE", 8):
+                with jsonl.write(path) as write:
+                    for row in rows:
+                        write(row)
+            with jsonl.read(path) as f:
+                self.assertListEqual(list(f), rows)
+
+    def test_nested_values_interned(self):
+        array = {"t": {"module": "numpy", "name": "ndarray"}, "v": {"dtype": "int64"}}
+        rows = [
+            {"location": "a.py:1", "params": {"args": [array, {"t": "int"}]}},
+            {"location": "a.py:2", "params": {"args": [{"t": "float"}, array]}},
+            {"location": "a.py:3", "params": {"args": [], "kwargs": {}}},
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.bin")
+            with jsonl.write(path) as write:
+                for row in rows:
+                    write(row)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read().count(b"ndarray"), 1)
+            with jsonl.read(path) as f:
+                self.assertListEqual(list(f), rows)
+
+
+class TestCompression(unittest.TestCase):
+    def test_round_trip(self):
+        rows = [{"location": f"a.py:{i}", "function": {"t": "len"}} for i in range(10)]
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["raw.jsonl.gz", "raw.jsonl.bz2", "raw.jsonl.xz", "raw.bin.gz"]:
+                with self.subTest(name):
+                    path = os.path.join(directory, name)
+                    with jsonl.write(path) as write:
+                        for row in rows:
+                            write(row)
+                    with jsonl.read(path) as f:
+                        self.assertListEqual(list(f), rows)
+
+
+class TestWriter(unittest.TestCase):
+    def test_threads(self):
+        rows = [
+            [{"location": f"a.py:{i}", "function": {"t": f"f{j}"}} for i in range(500)]
+            for j in range(4)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.jsonl")
+            with patch.object(jsonl, "THREAD_BUFFER_SIZE", 256):
+                with jsonl.write(path) as write:
+
+                    def write_rows(thread_rows):
+                        for row in thread_rows:
+                            write(row)
+
+                    threads = [
+                        threading.Thread(target=write_rows, args=(thread_rows,))
+                        for thread_rows in rows
+                    ]
+                    for thread in threads:
+                        thread.start()
+                    # Flush while they are writing
+                    write.flush()
+                    for thread in threads:
+                        thread.join()
+                    write.flush()
+                    # The buffers of threads which exited are forgotten
+                    self.assertListEqual(write.thread_buffers, [])
+            with jsonl.read(path) as f:
+                written = list(f)
+        # Each thread's rows are whole and in order
+        for thread_rows in rows:
+            function = thread_rows[0]["function"]
+            self.assertListEqual(
+                [row for row in written if row["function"] == function], thread_rows
+            )
+
+
+class TestBackgroundWriter(unittest.TestCase):
+    def test_call_soon(self):
+        rows = [{"location": f"a.py:{i}", "function": {"t": "len"}} for i in range(10)]
+        logged = core.LoggedCall(rows[0])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.jsonl")
+            with jsonl.write_in_background(path, 1) as write:
+                for row in rows:
+                    write(row)
+                self.assertTrue(write.call_soon(logged.serialize))
+            self.assertEqual(logged.row, orjson.dumps(rows[0]))
+            with jsonl.read(path) as f:
+                self.assertListEqual(list(f), rows)
+
+    def test_closed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.jsonl")
+            with jsonl.write_in_background(path, 1) as write:
+                pass
+            self.assertFalse(write.call_soon(lambda: None))
+            with self.assertRaises(ValueError):
+                for _ in range(3):
+                    write({"location": "a.py:1"})
+
+
+class TestRead(unittest.TestCase):
+    def test_fifo(self):
+        rows = [{"location": f"a.py:{i}", "function": {"t": "len"}} for i in range(10)]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "raw.jsonl")
+            os.mkfifo(path)
+
+            def write_rows():
+                with jsonl.write(path) as write:
+                    for row in rows:
+                        write(row)
+
+            thread = threading.Thread(target=write_rows)
+            thread.start()
+            with jsonl.read(path) as f:
+                self.assertListEqual(list(f), rows)
+            thread.join()
+
+    def test_chunks(self):
+        rows = [{"location": f"a.py:{i}", "function": {"t": "len"}} for i in range(100)]
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["raw.jsonl", "raw.jsonl.gz"]:
+                with self.subTest(name):
+                    path = os.path.join(directory, name)
+                    with jsonl.write(path) as write:
+                        for row in rows:
+                            write(row)
+                    chunks = list(
+                        jsonl.read_chunks(path, list, workers=2, chunk_size=256)
+                    )
+                    self.assertListEqual([row for chunk in chunks for row in chunk], rows)
+
+
+FORK_USAGE = """
+import multiprocessing
+import os
+
+import numpy as np
+
+
+def work(i):
+    return int(np.arange(i).sum())
+
+
+if __name__ == "__main__":
+    pid = os.fork()
+    if not pid:
+        work(1)
+    else:
+        os.waitpid(pid, 0)
+        # Exits without running `atexit` hooks, like pool workers
+        process = multiprocessing.get_context("fork").Process(target=work, args=(2,))
+        process.start()
+        process.join()
+"""
+
+
+class TestFork(unittest.TestCase):
+    def test_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "fork_usage.py"), "w") as f:
+                f.write(FORK_USAGE)
+            path = os.path.join(directory, "out.jsonl")
+            subprocess.run(
+                [sys.executable, "-m", "record_api"],
+                env={
+                    **os.environ,
+                    "PYTHONPATH": os.pathsep.join(
+                        [os.path.dirname(os.path.dirname(__file__)), directory]
+                    ),
+                    "PYTHON_RECORD_API_OUTPUT_FILE": path,
+                    "PYTHON_RECORD_API_TO_MODULES": "numpy",
+                    "PYTHON_RECORD_API_FROM_MODULES": "fork_usage",
+                },
+                check=True,
+            )
+            shards = [
+                os.path.join(directory, name)
+                for name in os.listdir(directory)
+                if ".shard-" in name
+            ]
+            # The forked process and the `multiprocessing` one
+            self.assertEqual(len(shards), 2)
+            for shard in shards:
+                with jsonl.read(shard) as f:
+                    names = {row["function"]["v"].get("name") for row in f}
+                self.assertIn("arange", names)
+
+
+XDIST_USAGE = """
+import numpy as np
+
+
+def test_int():
+    np.arange(3)
+
+
+def test_float():
+    np.arange(3.0)
+
+
+def test_int_again():
+    np.arange(4)
+"""
+
+
+@unittest.skipUnless(importlib.util.find_spec("xdist"), "needs pytest-xdist")
+class TestXdist(unittest.TestCase):
+    def test_grouped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "test_xdist_usage.py"), "w") as f:
+                f.write(XDIST_USAGE)
+            path = os.path.join(directory, "out.jsonl")
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "pytest",
+                    "-p",
+                    "record_api.pytest_plugin",
+                    "-p",
+                    "xdist",
+                    "-n",
+                    "2",
+                    "-p",
+                    "no:cacheprovider",
+                    "test_xdist_usage.py",
+                ],
+                cwd=directory,
+                env={
+                    **os.environ,
+                    "PYTHONPATH": os.path.dirname(os.path.dirname(__file__)),
+                    "PYTEST_DISABLE_PLUGIN_AUTOLOAD": "true",
+                    "PYTHON_RECORD_API_OUTPUT_FILE": path,
+                    "PYTHON_RECORD_API_TO_MODULES": "numpy",
+                    "PYTHON_RECORD_API_FROM_MODULES": "test_xdist_usage",
+                },
+                check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            # The workers' shards are merged into the grouped rows
+            shards = [name for name in os.listdir(directory) if ".shard-" in name]
+            self.assertListEqual(shards, [])
+            with jsonl.read(os.path.join(directory, "out.grouped.jsonl")) as f:
+                rows = [row for row in f if row["function"]["v"]["name"] == "arange"]
+        self.assertCountEqual(
+            [(row["params"]["args"], row["n"]) for row in rows],
+            [([{"t": "int"}], 2), ([{"t": "float"}], 1)],
+        )
+
+
+class TestAggregate(unittest.TestCase):
+    def test_grouped(self):
+        a = np.arange(3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "grouped.jsonl")
+            with patch.dict(os.environ, {"PYTHON_RECORD_API_OUTPUT_FILE": path}):
+                core.setup(path, aggregate=True)
+                try:
+                    with Tracer(["numpy"], ["record_api.test"]):
+                        exec("a + 1\na + 1\na + 1.0")
+                finally:
+                    core.finalize()
+            with jsonl.read(path) as f:
+                rows = list(f)
+        # Grouped like `line_counts`, counting the locations of each call
+        self.assertListEqual(
+            [(row["bound_params"]["pos_only"][1][1], row["n"]) for row in rows],
+            [({"t": "int"}, 2), ({"t": "float"}, 1)],
+        )
+
+
+class TestLineCounts(unittest.TestCase):
+    def test_partitioned(self):
+        rows = [
+            {"location": f"a.py:{i % 7}", "function": {"t": f"f{i % 5}"}, "count": i}
+            for i in range(100)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            raw = os.path.join(directory, "raw.jsonl")
+            with jsonl.write(raw) as write:
+                for row in rows:
+                    write(row)
+            outputs = []
+            for max_size, workers in [(None, 1), (50, 1), (None, 2), (50, 2)]:
+                output = os.path.join(directory, f"grouped-{max_size}-{workers}.jsonl")
+                with patch.object(jsonl, "CHUNK_SIZE", 256):
+                    line_counts.group([raw, raw], output, max_size, workers)
+                with open(output, "rb") as f:
+                    outputs.append(f.read())
+            self.assertEqual(len(set(outputs)), 1)
+            # The spilled rows are removed
+            self.assertEqual(len(os.listdir(directory)), 5)
+
+    def test_split_partitions(self):
+        rows = [
+            {"location": f"a.py:{i % 7}", "function": {"t": f"f{i % 50}"}}
+            for i in range(200)
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            raw = os.path.join(directory, "raw.jsonl")
+            with jsonl.write(raw) as write:
+                for row in rows:
+                    write(row)
+            outputs = []
+            group_partition = line_counts.group_partition
+            for max_size in [None, 200]:
+                output = os.path.join(directory, f"grouped-{max_size}.jsonl")
+                with patch.object(line_counts, "PARTITIONS", 2), patch.object(
+                    line_counts, "group_partition", wraps=group_partition
+                ) as grouped:
+                    line_counts.group([raw], output, max_size or sys.maxsize)
+                with open(output, "rb") as f:
+                    outputs.append(f.read())
+            self.assertEqual(outputs[0], outputs[1])
+            # The partitions with more than `max_size` bytes of groups are split again
+            self.assertGreater(max(call.args[-1] for call in grouped.call_args_list), 2)
+            # The partitions grouped in workers are split the same way
+            output = os.path.join(directory, "grouped-parallel.jsonl")
+            with patch.object(line_counts, "PARTITIONS", 2):
+                line_counts.group([raw], output, 200, workers=2)
+            with open(output, "rb") as f:
+                self.assertEqual(f.read(), outputs[0])
+            self.assertEqual(len(os.listdir(directory)), 4)
+
+    def test_calls(self):
+        rows: typing.List[dict] = [
+            {"location": "a.py:1", "function": {"t": "f"}},
+            {"location": "a.py:2", "function": {"t": "f"}},
+            {"location": "a.py:1", "function": {"t": "g"}},
+            # Written at the end, for the repeated calls
+            {"location": "a.py:1", "function": {"t": "f"}, "count": 4},
+        ]
+        calls = line_counts.Calls()
+        for row in rows:
+            calls.add(row)
+        self.assertListEqual(
+            list(calls.rows()),
+            [
+                {"function": {"t": "f"}, "n": 2, "calls": 6},
+                {"function": {"t": "g"}, "n": 1, "calls": 1},
+            ],
+        )
+
+    def test_locations(self):
+        table = line_counts.Locations()
+        locations = ["a.py:1", "a.py:2", "a.py:None", "a.py:007", "a.py", ":3", "a.py:0"]
+        ids = [table.id(location) for location in locations]
+        self.assertEqual(len(set(ids)), len(locations))
+        self.assertEqual([table.id(location) for location in locations], ids)
+        self.assertListEqual([table.location(id_) for id_ in ids], locations)
+        self.assertEqual(len(table.paths), 4)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -231,6 +231,16 @@ class ListInput(InputTypeBase):
         return ListOutput(item=unify(map(to_output, self.__root__)))
 
 
+class TruncatedListInput(InputTypeBase):
+    t: typing.Literal["list"]
+    # The first items
+    v: typing.List[InputType]
+    truncated: typing.Literal[True]
+
+    def to_output(self) -> ListOutput:
+        return ListOutput(item=unify_inputs(self.v))
+
+
 class ListOutput(OutputTypeBase):
     type: typing.Literal["list"] = "list"
     item: OutputType
@@ -251,8 +261,13 @@ class ListOutput(OutputTypeBase):
 class TupleInput(InputTypeBase):
     t: typing.Literal["tuple"]
     v: typing.List[InputType]
+    # Whether only the first items were recorded
+    truncated: bool = False
 
     def to_output(self) -> TupleOutput:
+        if self.truncated:
+            # Too long to be a fixed length tuple
+            return TupleOutput(items=unify_inputs(self.v))
         return TupleOutput(items=list(map(to_output, self.v)))
 
 
@@ -306,6 +321,8 @@ class TupleOutput(OutputTypeBase):
 class DictInput(InputTypeBase):
     t: typing.Literal["dict"]
     v: typing.List[typing.Tuple[InputType, InputType]]
+    # Whether only the first items were recorded
+    truncated: bool = False
 
     def to_output(self) -> DictOutput:
         if self.v:
@@ -758,6 +775,23 @@ class NumpyConvert2MAInputType(BaseModel):
     name: typing.Literal["_convert2ma"]
 
 
+class NumpyArrayFunctionDispatcherInput(InputTypeBase):
+    """
+    A NumPy function which dispatches with `__array_function__`, from NumPy 1.25.
+    """
+
+    t: NumpyArrayFunctionDispatcherInputType
+    v: NamedInput
+
+    def to_output(self) -> FunctionOutput:
+        return FunctionOutput(name=NamedOutput.from_input(self.v))
+
+
+class NumpyArrayFunctionDispatcherInputType(BaseModel):
+    module: typing.Literal["numpy"]
+    name: typing.Literal["_ArrayFunctionDispatcher"]
+
+
 class NumpyNDArrayInput(InputTypeBase):
     t: ModuleNamedInput
     v: NumpyNDArrayValue
@@ -831,6 +865,7 @@ InputType = typing.Union[
     None,
     StringInput,
     ListInput,
+    TruncatedListInput,
     TupleInput,
     DictInput,
     OtherInputType,
@@ -844,6 +879,7 @@ InputType = typing.Union[
     MethodDescriptorInput,
     NumpyUfuncInput,
     NumpyConvert2MAInput,
+    NumpyArrayFunctionDispatcherInput,
     NumpyNDArrayInput,
     NumpyDTypeInput,
     OtherTypeInput,